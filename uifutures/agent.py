@@ -0,0 +1,186 @@
+"""Runs jobs for a host on another machine.
+
+An agent connects to a host which is listening for them (see the
+``agent_address`` argument to :class:`~uifutures.executor.Executor`),
+registers how many slots it has, and then runs each job it is sent in a local
+worker, relaying the worker's messages back to the host tagged with the job's
+uuid::
+
+    python -m uifutures.agent workstation:9999 --slots 8
+
+Both sides must share an authkey (``--authkey`` or ``$UIFUTURES_AGENT_AUTHKEY``),
+as the messages are pickles.
+
+"""
+
+from multiprocessing import connection
+import argparse
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import _multiprocessing
+
+from . import utils
+from .spawn import Spawner
+
+
+def parse_address(address):
+    """Turn ``"host:port"`` into ``("host", port)``."""
+    if isinstance(address, basestring):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return tuple(address)
+
+
+def listen(address):
+    """Open a socket for agents to connect to."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(parse_address(address))
+    sock.listen(16)
+    return sock
+
+
+# How long (in seconds) a new connection may take to answer each step of
+# the authentication before we give up on it.
+AUTH_TIMEOUT = 10.0
+
+
+def _set_timeout(client, timeout):
+    # Python's own socket timeouts make the socket non-blocking, which the
+    # Connection sharing it can't handle, so we have the kernel do it.
+    timeval = struct.pack('ll', int(timeout), int(timeout % 1 * 1000000))
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+
+
+def accept(sock):
+    """Accept a connection on a socket from :func:`listen`, which must then
+    be given to :func:`authenticate`."""
+    client, _ = sock.accept()
+    return client
+
+
+def authenticate(client, authkey, timeout=AUTH_TIMEOUT):
+    """Authenticate an accepted connection like
+    :class:`multiprocessing.connection.Listener` would, and return it as a
+    Connection.
+    
+    This blocks until the other end answers, or has been silent for
+    ``timeout`` seconds (when it raises IOError), so the host calls it from
+    another thread.
+    
+    """
+    try:
+        _set_timeout(client, timeout)
+        conn = _multiprocessing.Connection(os.dup(client.fileno()))
+        try:
+            connection.deliver_challenge(conn, authkey)
+            connection.answer_challenge(conn, authkey)
+        except:
+            conn.close()
+            raise
+        # Agents may be quiet for as long as their jobs are.
+        _set_timeout(client, 0)
+    finally:
+        client.close()
+    return conn
+
+
+def main():
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address', help='host:port of the host to serve')
+    parser.add_argument('-s', '--slots', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-k', '--authkey', default=os.environ.get('UIFUTURES_AGENT_AUTHKEY'))
+    parser.add_argument('-p', '--preload', help='comma-separated modules for workers to import up front')
+    parser.add_argument('--fork-server', action='store_true')
+    parser.add_argument('-n', '--name', default=socket.gethostname())
+    args = parser.parse_args()
+    
+    if not args.authkey:
+        parser.error('an authkey is required')
+    
+    host = connection.Client(parse_address(args.address), authkey=args.authkey)
+    host.send(dict(
+        type='register',
+        name=args.name,
+        slots=args.slots,
+        pid=os.getpid(),
+        codecs=utils.available_codecs,
+    ))
+    
+    spawner = Spawner(args.preload.split(',') if args.preload else None, fork_server=args.fork_server)
+    
+    # Worker processes by their connection, and uuid.
+    by_conn = {}
+    by_uuid = {}
+    
+    try:
+        while True:
+            
+            rlist, _, _ = select.select([host] + by_conn.keys(), [], [])
+            for conn in rlist:
+                
+                if conn is host:
+                    
+                    try:
+                        msg = host.recv()
+                    except (EOFError, IOError):
+                        # Our host is gone, and so the workers are pointless.
+                        return
+                    
+                    if msg.get('type') == 'submit':
+                        process = spawner.acquire()
+                        by_conn[process.conn] = msg['uuid']
+                        by_uuid[msg['uuid']] = process
+                        process.conn.send(msg)
+                        if process.ready_at is not None:
+                            host.send(dict(type='handshake', uuid=msg['uuid'], pid=process.pid, agent=args.name))
+                        continue
+                    
+                    # The host has given up on the job.
+                    if msg.get('type') == 'kill':
+                        process = by_uuid.pop(msg['uuid'], None)
+                        if process is not None:
+                            process.proc.kill()
+                        continue
+                    
+                    # Anything else is for a job.
+                    process = by_uuid.get(msg.pop('uuid', None))
+                    if process is not None:
+                        process.conn.send(msg)
+                    continue
+                
+                uuid = by_conn[conn]
+                try:
+                    msg = conn.recv()
+                except (EOFError, IOError):
+                    del by_conn[conn]
+                    # A finished job is expected to exit, and the host may
+                    # have already sent its uuid again to retry it.
+                    process = by_uuid.get(uuid)
+                    if process is None or process.conn is not conn:
+                        continue
+                    del by_uuid[uuid]
+                    msg = dict(type='shutdown')
+                
+                if msg.get('type') in ('result', 'exception'):
+                    by_uuid.pop(uuid, None)
+                
+                msg['uuid'] = uuid
+                if msg.get('type') == 'handshake':
+                    msg['agent'] = args.name
+                host.send(msg)
+    
+    finally:
+        spawner.close()
+        for conn in by_conn:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
+
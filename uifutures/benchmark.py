@@ -0,0 +1,236 @@
+"""Benchmarks for the executor, host and workers.
+
+Run headless with::
+
+    python -m uifutures.benchmark --json bench.json
+
+Every benchmark is a ``bench_*`` function which is given an executor and the
+parsed options, and returns a dict of measurements. Results are written as a
+single JSON document so that runs can be compared over time.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from concurrent import futures as _futures
+
+# The jobs are in their own module, as workers can't import __main__.
+from .benchmark_jobs import noop, report_start, send_progress, make_payload, wait_for_path
+from .executor import Executor
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return dict(
+        min=values[0],
+        p50=pick(0.5),
+        p90=pick(0.9),
+        max=values[-1],
+        mean=sum(values) / len(values),
+    )
+
+
+def _get_rss(pid):
+    """Resident set size of the given process in bytes, or None if we can't
+    tell on this platform."""
+    try:
+        with open('/proc/%d/status' % pid) as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+
+
+def bench_submit_latency(executor, opts):
+    latencies = []
+    for i in xrange(opts.latency_jobs):
+        submitted = time.time()
+        started = executor.submit(report_start).result()
+        latencies.append(started - submitted)
+    return dict(jobs=opts.latency_jobs, seconds=_percentiles(latencies))
+
+
+def bench_noop_throughput(executor, opts):
+    start = time.time()
+    futures = [executor.submit(noop) for i in xrange(opts.noop_jobs)]
+    for future in futures:
+        future.result()
+    elapsed = time.time() - start
+    return dict(jobs=opts.noop_jobs, elapsed=elapsed, jobs_per_sec=opts.noop_jobs / elapsed)
+
+
+def bench_as_completed(executor, opts):
+    results = {}
+    for name, as_completed in (('executor', executor.as_completed), ('generic', _futures.as_completed)):
+        futures = [executor.submit(noop) for i in xrange(opts.as_completed_jobs)]
+        start = time.time()
+        for future in as_completed(futures):
+            pass
+        results[name + '_elapsed'] = time.time() - start
+    results['jobs'] = opts.as_completed_jobs
+    return results
+
+
+def bench_progress_rate(executor, opts):
+    
+    # Subtract the cost of an empty job so we are left with the messages.
+    start = time.time()
+    executor.submit(send_progress, 0).result()
+    baseline = time.time() - start
+    
+    start = time.time()
+    executor.submit(send_progress, opts.progress_messages).result()
+    elapsed = max(1e-6, time.time() - start - baseline)
+    
+    return dict(
+        messages=opts.progress_messages,
+        elapsed=elapsed,
+        messages_per_sec=opts.progress_messages / elapsed,
+    )
+
+
+def bench_result_throughput(executor, opts):
+    sizes = {}
+    for size in opts.payload_sizes:
+        start = time.time()
+        executor.submit(make_payload, size).result()
+        elapsed = time.time() - start
+        sizes[str(size)] = dict(elapsed=elapsed, bytes_per_sec=size / elapsed)
+    return dict(sizes=sizes)
+
+
+def bench_queued_memory(executor, opts):
+    
+    if executor.backend != 'host':
+        return dict(skipped='only measured for the host backend')
+    
+    end_time = time.time() + 30
+    while executor.host_pid is None and time.time() < end_time:
+        time.sleep(0.01)
+    if executor.host_pid is None or _get_rss(executor.host_pid) is None:
+        return dict(skipped='cannot read host memory')
+    
+    def settled_rss():
+        # There is no acknowledgement of submissions, so wait for the host's
+        # memory to stop changing.
+        last = None
+        stable = 0
+        while stable < 3:
+            time.sleep(0.2)
+            rss = _get_rss(executor.host_pid)
+            stable = stable + 1 if rss == last else 0
+            last = rss
+        return last
+    
+    tmp_dir = tempfile.mkdtemp(prefix='uifutures-bench.')
+    try:
+        
+        # Everything queues up behind this one.
+        flag = os.path.join(tmp_dir, 'release')
+        blocker = executor.submit(wait_for_path, flag)
+        before = settled_rss()
+        
+        futures = [executor.submit_ext(noop, depends_on=[blocker]) for i in xrange(opts.queued_jobs)]
+        after = settled_rss()
+        
+        open(flag, 'w').close()
+        for future in futures:
+            future.result()
+    
+    finally:
+        shutil.rmtree(tmp_dir)
+    
+    return dict(
+        jobs=opts.queued_jobs,
+        rss_before=before,
+        rss_after=after,
+        bytes_per_job=float(after - before) / opts.queued_jobs,
+    )
+
+
+def bench_dag_wide(executor, opts):
+    start = time.time()
+    root = executor.submit(noop)
+    children = [executor.submit_ext(noop, depends_on=[root]) for i in xrange(opts.dag_width)]
+    executor.submit_ext(noop, depends_on=children).result()
+    elapsed = time.time() - start
+    jobs = opts.dag_width + 2
+    return dict(jobs=jobs, elapsed=elapsed, seconds_per_job=elapsed / jobs)
+
+
+def bench_dag_deep(executor, opts):
+    start = time.time()
+    future = executor.submit(noop)
+    for i in xrange(opts.dag_depth - 1):
+        future = executor.submit_ext(noop, depends_on=[future])
+    future.result()
+    elapsed = time.time() - start
+    return dict(jobs=opts.dag_depth, elapsed=elapsed, seconds_per_job=elapsed / opts.dag_depth)
+
+
+benchmarks = sorted(
+    (name[6:], func) for name, func in globals().items()
+    if name.startswith('bench_')
+)
+
+
+def main():
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--backend', default='host')
+    parser.add_argument('-w', '--max-workers', type=int, default=8)
+    parser.add_argument('-o', '--json', help='write results to this file instead of stdout')
+    parser.add_argument('--latency-jobs', type=int, default=20)
+    parser.add_argument('--noop-jobs', type=int, default=200)
+    parser.add_argument('--as-completed-jobs', type=int, default=200)
+    parser.add_argument('--progress-messages', type=int, default=10000)
+    parser.add_argument('--payload-sizes', type=lambda x: [int(y) for y in x.split(',')],
+        default=[1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+    parser.add_argument('--queued-jobs', type=int, default=200)
+    parser.add_argument('--dag-width', type=int, default=100)
+    parser.add_argument('--dag-depth', type=int, default=20)
+    parser.add_argument('only', nargs='*', help='names of benchmarks to run; defaults to all')
+    opts = parser.parse_args()
+    
+    # The host inherits this, so no display is required.
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    
+    results = {}
+    for name, func in benchmarks:
+        if opts.only and name not in opts.only:
+            continue
+        print >> sys.stderr, 'Running %s...' % name
+        # A fresh executor each time so that one benchmark's stragglers don't
+        # pollute the next.
+        with Executor(max_workers=opts.max_workers, backend=opts.backend) as executor:
+            results[name] = func(executor, opts)
+    
+    output = dict(
+        time=time.time(),
+        python=sys.version,
+        platform=platform.platform(),
+        node=platform.node(),
+        options=dict((k, v) for k, v in vars(opts).iteritems() if k not in ('json', 'only')),
+        results=results,
+    )
+    encoded = json.dumps(output, indent=4, sort_keys=True)
+    if opts.json:
+        with open(opts.json, 'w') as fh:
+            fh.write(encoded + '\n')
+    else:
+        print encoded
+
+
+if __name__ == '__main__':
+    main()
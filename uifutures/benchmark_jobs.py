@@ -0,0 +1,26 @@
+"""Jobs for :mod:`uifutures.benchmark`; they are kept here so that workers
+can import them even when the benchmarks are run as ``__main__``."""
+
+import os
+import time
+
+from .worker import set_progress
+
+
+def noop():
+    pass
+
+def report_start():
+    return time.time()
+
+def send_progress(count):
+    for i in xrange(count):
+        set_progress(i + 1, maximum=count, status='Progress %d of %d' % (i + 1, count))
+
+def make_payload(size):
+    return 'x' * size
+
+def wait_for_path(path, timeout=60):
+    end_time = time.time() + timeout
+    while not os.path.exists(path) and time.time() < end_time:
+        time.sleep(0.01)
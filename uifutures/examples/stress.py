@@ -0,0 +1,45 @@
+import sys
+import threading
+import time
+
+from uifutures import Executor
+
+
+def noop(i):
+    return i
+
+
+def main():
+    
+    thread_count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    
+    # Workers can't import __main__, so refer to the job by its real module.
+    import uifutures.examples.stress
+    
+    with Executor(max_workers=8) as executor:
+        
+        futures = []
+        futures_lock = threading.Lock()
+        
+        def submitter(offset):
+            for i in xrange(per_thread):
+                future = executor.submit_ext(uifutures.examples.stress.noop, args=(offset + i, ), name='Stress #%d' % (offset + i))
+                with futures_lock:
+                    futures.append((offset + i, future))
+        
+        start_time = time.time()
+        threads = [threading.Thread(target=submitter, args=(i * per_thread, )) for i in xrange(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        for expected, future in futures:
+            assert future.result() == expected, 'future %s returned %r' % (future.uuid, future.result())
+        
+        print '%d jobs from %d threads in %.3fs' % (len(futures), thread_count, time.time() - start_time)
+
+
+if __name__ == '__main__':
+    main()
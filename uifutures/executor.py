@@ -1,14 +1,22 @@
 from concurrent.futures import _base
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import connection
 import cPickle as pickle
+import collections
+import json
+import marshal
+import multiprocessing
 import os
+import pstats
 import select
 import subprocess
 import threading
 import time
 
-from .utils import debug
+from . import log
 from . import utils
+from . import spawn
+from . import worker
 from .future import Future
 
 
@@ -18,10 +26,201 @@ class HostShutdown(RuntimeError):
 class DependencyFailed(RuntimeError):
     pass
 
+class SubmitQueueFull(RuntimeError):
+    pass
+
+class JobTimeout(RuntimeError):
+    pass
+
+
+backends = ('host', 'thread', 'process_pool')
+
+
+class _LocalConnection(object):
+    
+    """Stands in for a worker's pipe when a job runs in the executor's own
+    process; messages go straight to the executor's handlers."""
+    
+    def __init__(self, executor, uuid):
+        self.executor = executor
+        self.uuid = uuid
+    
+    def send(self, msg):
+        msg = dict(msg)
+        msg['uuid'] = self.uuid
+        self.executor._dispatch(msg)
+
+
+class _QueueConnection(object):
+    
+    """Stands in for a worker's pipe in a pool process; messages are relayed
+    to the executor via a shared queue."""
+    
+    def __init__(self, queue, uuid):
+        self.queue = queue
+        self.uuid = uuid
+    
+    def send(self, msg):
+        msg = dict(msg)
+        msg['uuid'] = self.uuid
+        self.queue.put(msg)
+
+
+# Set in each process of the "process_pool" backend.
+_pool_queue = None
+
+class _Watcher(object):
+    
+    """Collects futures as they finish, for :meth:`Executor.as_completed` and
+    :meth:`Executor.wait`."""
+    
+    def __init__(self, futures):
+        self.pending = set(futures)
+        self.finished = collections.deque()
+        self.cond = threading.Condition()
+    
+    def add(self, future):
+        with self.cond:
+            if future in self.pending:
+                self.pending.remove(future)
+                self.finished.append(future)
+                self.cond.notify()
+    
+    def get(self, end_time=None):
+        """Get the next finished future, or None once there are no more."""
+        with self.cond:
+            while not self.finished:
+                if not self.pending:
+                    return
+                remaining = None if end_time is None else end_time - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise _base.TimeoutError('%d (of %d) futures unfinished' % (
+                        len(self.pending), len(self.pending) + len(self.finished)))
+                self.cond.wait(remaining)
+            return self.finished.popleft()
+
+
+def _pool_init(queue, preload):
+    global _pool_queue
+    _pool_queue = queue
+    spawn.preload(preload)
+
+def _pool_execute(msg):
+    worker.execute(_QueueConnection(_pool_queue, msg['uuid']), msg, local=True)
+
+class _ProfileData(object):
+    
+    """Wraps marshalled cProfile stats from a worker so that they may be
+    given to :class:`pstats.Stats`."""
+    
+    def __init__(self, data):
+        self.stats = marshal.loads(data)
+    
+    def create_stats(self):
+        pass
+
+
+def _thread_execute(executor, msg):
+    worker.execute(_LocalConnection(executor, msg['uuid']), msg, local=True, rusage=False)
+
 
 class Executor(_base.Executor):
     
-    def __init__(self, max_workers=None):
+    def __init__(self, max_workers=None, backend='host', stats_path=None, profile_dir=None,
+        metrics_path=None, metrics_interval=None, max_outstanding=None,
+        spill_threshold=None, preload=None, prespawn=None, fork_server=False,
+        stream_window=16, compression=None, compression_threshold=64 * 1024,
+        agent_address=None, agent_authkey=None, heartbeat_interval=None,
+        reuse_workers=False, affinity_delay=None, trace_path=None
+    ):
+        
+        if backend not in backends:
+            raise ValueError('backend must be one of %s; got %r' % (', '.join(backends), backend))
+        self.backend = backend
+        
+        # The connection is shared by every submitting thread, and the
+        # futures are shared with the listener thread.
+        self._send_lock = threading.Lock()
+        self._futures_lock = threading.Lock()
+        self._futures = {}
+        
+        # Watchers from as_completed and wait, which are given each future
+        # as it finishes.
+        self._watchers = []
+        self._watchers_lock = threading.Lock()
+        
+        # Job stats are appended here as JSON lines, if set.
+        self.stats_path = stats_path or os.environ.get('UIFUTURES_STATS_PATH')
+        self._stats_lock = threading.Lock()
+        
+        # Profiles of each job are saved here (by the host if we have one),
+        # and aggregated by func_name in memory.
+        self.profile_dir = profile_dir or os.environ.get('UIFUTURES_PROFILE_DIR')
+        self._profiles = {}
+        self._profiles_lock = threading.Lock()
+        
+        # The host writes snapshots of its health counters here.
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        
+        # Submissions block once this many jobs are unfinished; the host
+        # grants us more credit as they finish.
+        self.max_outstanding = max_outstanding
+        self._credits = max_outstanding
+        self._credit_cond = threading.Condition()
+        
+        # Packages at least this large are kept on disk by the host until
+        # their job starts.
+        self.spill_threshold = spill_threshold
+        
+        # Modules for workers to import before they are given a job, and how
+        # many workers the host should keep waiting with them imported.
+        self.preload = list(preload or [])
+        self.prespawn = prespawn
+        
+        # Have the host fork workers from a zygote which has already imported
+        # the preloads, rather than starting fresh interpreters.
+        self.fork_server = fork_server
+        
+        # How many items a generator job may stream ahead of the host.
+        self.stream_window = stream_window
+        
+        # Compress packages and results at least compression_threshold bytes
+        # long, with a codec negotiated in the host's handshake; True picks
+        # the best we both have, or a codec may be named.
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self._codec = None
+        
+        # The host listens for uifutures.agent connections here if set, which
+        # add their slots to the local max_workers. Once it is listening the
+        # actual address is set as agent_address.
+        self.agent_address = agent_address
+        self.agent_authkey = agent_authkey or os.environ.get('UIFUTURES_AGENT_AUTHKEY')
+        if agent_address and not self.agent_authkey:
+            raise ValueError('agent_authkey is required to listen for agents')
+        
+        # Workers send a heartbeat this often while their job runs, and the
+        # host kills any which miss a few once they have started up.
+        self.heartbeat_interval = heartbeat_interval
+        
+        # Have the host run many jobs in each worker process. A job with an
+        # affinity_key waits up to affinity_delay for a process which ran the
+        # same key (if one is busy) before taking any other.
+        self.reuse_workers = reuse_workers
+        self.affinity_delay = affinity_delay
+        
+        # The host records every message it handles here, for replaying with
+        # python -m uifutures.replay.
+        self.trace_path = trace_path
+        
+        # Set by the host's handshake.
+        self.host_pid = None
+        
+        self._host_alive = True
+        getattr(self, '_start_' + backend)(max_workers)
+    
+    def _start_host(self, max_workers):
 
         self._conn, child_conn = connection.Pipe()
 
@@ -42,75 +241,305 @@ class Executor(_base.Executor):
         # it is an OS pipe, we don't have to wait.
         
         # Send some configuration over.
-        if max_workers:
-            self._conn.send(dict(
-                type='config',
-                max_workers=max_workers,
-            ))
+        config = {}
+        if max_workers is not None:
+            config['max_workers'] = max_workers
+        if self.profile_dir:
+            config['profile_dir'] = self.profile_dir
+        if self.metrics_path:
+            config['metrics_path'] = self.metrics_path
+        if self.metrics_interval:
+            config['metrics_interval'] = self.metrics_interval
+        if self.max_outstanding:
+            config['credits'] = True
+        if self.spill_threshold is not None:
+            config['spill_threshold'] = self.spill_threshold
+        if self.preload:
+            config['preload'] = self.preload
+        if self.prespawn:
+            config['prespawn'] = self.prespawn
+        if self.fork_server:
+            config['fork_server'] = True
+        if self.agent_address:
+            config['agent_address'] = self.agent_address
+            config['agent_authkey'] = self.agent_authkey
+        if self.reuse_workers:
+            config['reuse_workers'] = True
+        if self.affinity_delay is not None:
+            config['affinity_delay'] = self.affinity_delay
+        if self.trace_path:
+            config['trace_path'] = self.trace_path
+        if config:
+            config['type'] = 'config'
+            self._send(config)
         
-        self._futures = {}
-        
-        self._host_alive = True
         self._host_listener_thread = threading.Thread(target=self._host_listener)
         self._host_listener_thread.daemon = True
         self._host_listener_thread.start()
     
+    def _start_thread(self, max_workers):
+        spawn.preload(self.preload)
+        self._pool = ThreadPoolExecutor(max_workers or multiprocessing.cpu_count())
+    
+    def _start_process_pool(self, max_workers):
+        
+        # Workers in the pool report back over this queue, which is drained
+        # by a listener just like the host's connection.
+        self._queue = multiprocessing.Queue()
+        self._pool = multiprocessing.Pool(max_workers, _pool_init, (self._queue, self.preload))
+        
+        self._host_listener_thread = threading.Thread(target=self._queue_listener)
+        self._host_listener_thread.daemon = True
+        self._host_listener_thread.start()
+    
+    def _send(self, msg):
+        with self._send_lock:
+            self._conn.send(msg)
+    
     def shutdown(self, wait=True):
-        self._conn.send(dict(
+        getattr(self, '_shutdown_' + self.backend)(wait)
+    
+    def _shutdown_host(self, wait):
+        self._send(dict(
             type='shutdown',
         ))
     
+    def _wait_for_futures(self):
+        # Jobs waiting on dependencies have not reached the pool yet, so we
+        # must wait on the futures themselves.
+        with self._futures_lock:
+            futures = self._futures.values()
+        _base.wait(futures)
+    
+    def _shutdown_thread(self, wait):
+        if wait:
+            self._wait_for_futures()
+        self._pool.shutdown(wait)
+        if wait:
+            self._do_shutdown()
+    
+    def _shutdown_process_pool(self, wait):
+        if wait:
+            self._wait_for_futures()
+        self._pool.close()
+        if wait:
+            self._pool.join()
+            self._queue.put(None)
+            self._host_listener_thread.join()
+    
+    def _dispatch(self, msg):
+        type_ = msg.pop('type', None)
+        log.debug('Executor: received %s for %s', type_, msg.get('uuid'))
+        handler = getattr(self, '_do_' + (type_ or 'missing'), None)
+        if not handler:
+            log.warning('Executor: no handler for %r', type_)
+            return
+        handler(**msg)
+    
     def _host_listener(self):
         try:
             while self._host_alive:
                 try:
                     rlist, _, _ = select.select([self._conn], [], [])
-                    msg = self._conn.recv()
-                    type_ = msg.pop('type', None)
-                    # debug('Executor: new message of type %r:\n%s', type_, pprint.pformat(msg))
-                    handler = getattr(self, '_do_' + (type_ or 'missing'), None)
-                    if not handler:
-                        debug('Executor: no handler for %r', type_)
-                        continue
-                    handler(**msg)
+                    self._dispatch(self._conn.recv())
                 except IOError as e:
                     if e.errno == 35:
-                        debug('Executor: socket temporarily unavailable; sleeping')
+                        log.info('Executor: socket temporarily unavailable; sleeping')
                         time.sleep(0.25)
                     else:
                         raise
         except EOFError:
+            # Don't log here (or in _do_shutdown); this is a daemon thread, so
+            # we may get here as the interpreter tears down, after the module
+            # globals (including those of the log module) are None. A clean
+            # shutdown is logged by _dispatch when the host says so.
             pass
-            # debug('Executor: EOF')
         finally:
             self._do_shutdown()
     
-    def _do_handshake(self, pid):
-        pass
+    def _queue_listener(self):
+        try:
+            while True:
+                msg = self._queue.get()
+                if msg is None:
+                    break
+                self._dispatch(msg)
+        finally:
+            self._do_shutdown()
+    
+    def _do_handshake(self, pid, codecs=()):
+        self.host_pid = pid
+        
+        # Settle on the first codec we both have.
+        if self.compression:
+            preferred = utils.available_codecs if self.compression is True else [self.compression]
+            self._codec = next((x for x in preferred if x in codecs and x in utils.codecs), None)
+    
+    def _do_listening(self, address):
+        self.agent_address = tuple(address)
     
     def _do_shutdown(self):
-        self._host_alive = False
-        # debug('Executor: host shutdown')
-        for future in self._futures.itervalues():
+        with self._futures_lock:
+            self._host_alive = False
+            futures = self._futures.values()
+            self._futures.clear()
+        for future in futures:
             future.set_exception(HostShutdown('host shutdown'))
+        
+        # Wake up anyone waiting to submit.
+        with self._credit_cond:
+            self._credit_cond.notify_all()
+    
+    def _acquire_credit(self, block, timeout):
+        
+        if self.max_outstanding is None:
+            return
+        
+        end_time = None if timeout is None else time.time() + timeout
+        with self._credit_cond:
+            while not self._credits:
+                if not self._host_alive:
+                    raise HostShutdown('host shutdown')
+                remaining = None if end_time is None else end_time - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise SubmitQueueFull('%d jobs are outstanding' % self.max_outstanding)
+                self._credit_cond.wait(remaining)
+            self._credits -= 1
+    
+    def _release_credit(self, count=1):
+        if self.max_outstanding is None:
+            return
+        with self._credit_cond:
+            self._credits += count
+            self._credit_cond.notify(count)
+    
+    def _do_credit(self, count):
+        self._release_credit(count)
+    
+    def _get_future(self, uuid):
+        with self._futures_lock:
+            return self._futures.get(uuid)
+    
+    def _pop_future(self, uuid):
+        # A job which was retried from the host UI will report a second time,
+        # but its future has already been resolved.
+        with self._futures_lock:
+            return self._futures.pop(uuid, None)
+    
+    def _finish_stats(self, future, stats, state):
+        
+        future.stats.update(stats or {})
+        future.stats['relayed'] = time.time()
+        
+        if not self.stats_path:
+            return
+        record = dict(
+            uuid=future.uuid,
+            func_name=future.func_name,
+            state=state,
+            stats=future.stats,
+            durations=dict(utils.get_durations(future.stats)),
+        )
+        encoded = json.dumps(record, sort_keys=True)
+        with self._stats_lock:
+            with open(self.stats_path, 'a') as fh:
+                fh.write(encoded + '\n')
+    
+    def _add_profile(self, future, profile):
+        
+        if self.profile_dir and self.backend != 'host':
+            utils.save_profile(self.profile_dir, future.uuid, profile)
+        
+        with self._profiles_lock:
+            existing = self._profiles.get(future.func_name)
+            if existing is None:
+                self._profiles[future.func_name] = pstats.Stats(_ProfileData(profile))
+            else:
+                existing.add(_ProfileData(profile))
+    
+    def get_profile(self, func_name):
+        """Get a :class:`pstats.Stats` aggregated across every profiled job of
+        the given function (or function name), or None if there are none."""
+        func_name = utils.get_func_name(func_name)
+        with self._profiles_lock:
+            return self._profiles.get(func_name)
     
     def _do_result(self, uuid, **msg):
-        # debug('Executor: %s finished', uuid)
-        future = self._futures.pop(uuid)
+        log.debug('Executor: %s finished', uuid)
+        future = self._pop_future(uuid)
+        if future is None:
+            return
+        
+        future.stats.update(msg.get('stats') or {})
+        if 'package' in msg:
+            result = pickle.loads(utils.unpack(msg['package'], msg.get('package_codec'), future.stats, 'result'))['result']
+        else:
+            result = msg['result']
         
-        result = (pickle.loads(msg['package']) if 'package' in msg else msg)['result']
+        self._finish_stats(future, None, 'COMPLETE')
+        if 'profile' in msg:
+            self._add_profile(future, msg['profile'])
         future.set_result(result)
         
     def _do_exception(self, uuid, **msg):
-        # debug('Executor: %s errored', uuid)
-        future = self._futures.pop(uuid)
+        log.debug('Executor: %s errored', uuid)
+        future = self._pop_future(uuid)
+        if future is None:
+            return
+        self._finish_stats(future, msg.get('stats'), 'FAILED')
+        if 'profile' in msg:
+            self._add_profile(future, msg['profile'])
         exception = (pickle.loads(msg['package']) if 'package' in msg else msg)['exception']
         future.set_exception(exception)
     
+    def _do_retry(self, uuid, attempt, **msg):
+        future = self._get_future(uuid)
+        if future is not None:
+            future.retries = attempt
+    
+    def _do_yield(self, uuid, package, package_codec=None):
+        future = self._get_future(uuid)
+        if future is not None:
+            future._stream_put(pickle.loads(utils.unpack(package, package_codec))['item'])
+    
+    # Only the in-process backends send us worker messages directly; the host
+    # consumes these itself.
+    
+    def _do_progress(self, uuid, **msg):
+        future = self._get_future(uuid)
+        if future is not None:
+            future.progress = msg
+    
+    def _do_notify(self, uuid, **msg):
+        utils.notify(**msg)
+    
+    def _do_thumbnail(self, uuid, path):
+        pass
+    
     def submit(self, func, *args, **kwargs):
-        self.submit_ext(func, args, kwargs)
+        return self.submit_ext(func, args, kwargs)
     
-    def submit_ext(self, func, args=None, kwargs=None, name=None, icon=None, depends_on=None):
+    def submit_ext(self, func, args=None, kwargs=None, name=None, icon=None, depends_on=None,
+        profile=False, block=True, timeout=None, retries=0, retry_backoff=1.0,
+        job_timeout=None, affinity_key=None
+    ):
+        """Submit a job, with more options than :meth:`submit`.
+        
+        If the executor has ``max_outstanding`` jobs unfinished, this will
+        wait for one to finish (up to ``timeout`` seconds), or raise
+        :class:`SubmitQueueFull` immediately if not ``block``.
+        
+        The host will run a failed job up to ``retries`` more times, waiting
+        ``retry_backoff`` seconds before the first and doubling each time;
+        :attr:`Future.retries` counts them. Generator jobs start over.
+        
+        The host kills a job which runs for longer than ``job_timeout``
+        seconds, failing it with :class:`JobTimeout` (unless it is retried).
+        
+        With ``reuse_workers``, jobs with the same ``affinity_key`` (e.g. the
+        scene they load) prefer to run in the same worker process.
+        
+        """
         
         uuid = os.urandom(16).encode('hex')
         func_name = utils.get_func_name(func)
@@ -118,25 +547,174 @@ class Executor(_base.Executor):
         depends_on = depends_on or []
         if not isinstance(depends_on, (list, tuple)):
             depends_on = [depends_on]
-        depends_on = [x.uuid for x in depends_on]
         
-        self._conn.send(dict(
+        package = pickle.dumps(dict(
+            func=func,
+            args=tuple(args or ()),
+            kwargs=dict(kwargs or {}),
+        ), protocol=-1)
+        pack_stats = {}
+        package, codec = utils.pack(package, self._codec, self.compression_threshold, pack_stats)
+        
+        self._acquire_credit(block, timeout)
+        
+        # Register the future before sending, since a fast job may report
+        # back to the listener thread before we would otherwise get to it.
+        future = Future(uuid, func_name)
+        future.add_done_callback(self._on_done)
+        future.stats.update(pack_stats)
+        future.stats['submitted'] = submitted = time.time()
+        with self._futures_lock:
+            if not self._host_alive:
+                self._release_credit()
+                raise HostShutdown('host shutdown')
+            self._futures[uuid] = future
+        
+        msg = dict(
             type='submit',
             uuid=uuid,
             name=name or func_name,
             icon=icon,
             func_name=func_name,
-            depends_on=depends_on,
-            package=pickle.dumps(dict(
-                func=func,
-                args=tuple(args or ()),
-                kwargs=dict(kwargs or {}),
-            ), protocol=-1),
-        ))
+            depends_on=[x.uuid for x in depends_on],
+            package=package,
+            package_codec=codec,
+            submitted=submitted,
+            profile=profile,
+        )
+        
+        # Generators in the host's workers must wait for it to acknowledge
+        # their items; in process they are delivered synchronously, or queued.
+        if self.backend == 'host':
+            msg['stream_window'] = self.stream_window
+        
+        # Only the host schedules retries, and can kill jobs.
+        if self.backend == 'host':
+            if retries:
+                msg['retries'] = retries
+                msg['retry_backoff'] = retry_backoff
+            if job_timeout:
+                msg['job_timeout'] = job_timeout
+            if affinity_key is not None:
+                msg['affinity_key'] = affinity_key
+            if self.heartbeat_interval:
+                msg['heartbeat_interval'] = self.heartbeat_interval
+        
+        # Compression is only negotiated with the host.
+        if self._codec:
+            msg['result_codec'] = self._codec
+            msg['compression_threshold'] = self.compression_threshold
+        
+        if self.backend == 'host':
+            self._send(msg)
+        else:
+            future.add_done_callback(lambda _: self._release_credit())
+            self._submit_local(msg, depends_on)
         
-        future = Future(uuid)
-        self._futures[uuid] = future
         return future
+    
+    def _on_done(self, future):
+        if self._watchers:
+            with self._watchers_lock:
+                watchers = list(self._watchers)
+            for watcher in watchers:
+                watcher.add(future)
+    
+    def _watch(self, futures):
+        
+        watcher = _Watcher(futures)
+        with self._watchers_lock:
+            self._watchers.append(watcher)
+        
+        # Anything which finished before we were watching.
+        with watcher.cond:
+            done = [x for x in watcher.pending if x.done()]
+            watcher.pending.difference_update(done)
+            watcher.finished.extend(done)
+        
+        return watcher
+    
+    def _unwatch(self, watcher):
+        with self._watchers_lock:
+            self._watchers.remove(watcher)
+    
+    def as_completed(self, futures, timeout=None):
+        """Like :func:`concurrent.futures.as_completed`, but the futures must
+        be from this executor.
+        
+        Rather than waiting on every future, we are handed each one as it
+        finishes, so large sets don't cost more per completion.
         
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        watcher = self._watch(futures)
+        try:
+            while True:
+                future = watcher.get(end_time)
+                if future is None:
+                    return
+                yield future
+        finally:
+            self._unwatch(watcher)
+    
+    def wait(self, futures, timeout=None, return_when=_base.ALL_COMPLETED):
+        """Like :func:`concurrent.futures.wait`, but the futures must be from
+        this executor; see :meth:`as_completed`."""
+        
+        end_time = None if timeout is None else time.time() + timeout
+        watcher = self._watch(futures)
+        done = set()
+        try:
+            while True:
+                future = watcher.get(end_time)
+                if future is None:
+                    break
+                done.add(future)
+                if return_when == _base.FIRST_COMPLETED:
+                    break
+                if return_when == _base.FIRST_EXCEPTION and not future.cancelled() and future.exception() is not None:
+                    break
+        except _base.TimeoutError:
+            pass
+        finally:
+            self._unwatch(watcher)
+        
+        with watcher.cond:
+            done.update(watcher.finished)
+            return _base.DoneAndNotDoneFutures(done, set(watcher.pending))
+    
+    def _submit_local(self, msg, depends_on):
+        
+        # The host takes care of dependencies for us, but in process we must
+        # hold the job back until they are all done.
+        pending = [x for x in depends_on if not x.done()]
+        if not pending:
+            self._start_local(msg, depends_on)
+            return
+        
+        remaining = [len(pending)]
+        lock = threading.Lock()
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                ready = not remaining[0]
+            if ready:
+                self._start_local(msg, depends_on)
+        for dependency in pending:
+            dependency.add_done_callback(on_done)
+    
+    def _start_local(self, msg, depends_on):
+        
+        if any(x.cancelled() or x.exception() is not None for x in depends_on):
+            self._dispatch(dict(
+                type='exception',
+                uuid=msg['uuid'],
+                exception=DependencyFailed('dependency failed'),
+            ))
+            return
         
+        if self.backend == 'thread':
+            self._pool.submit(_thread_execute, self, msg)
+        else:
+            self._pool.apply_async(_pool_execute, (msg, ))
 
@@ -0,0 +1,113 @@
+"""A zygote which forks new workers for the host.
+
+The host starts this once (with ``$UIFUTURES_PRELOAD`` set), and then for each
+worker it sends a ``fork`` message followed by the worker's end of a fresh
+pipe. We fork, and the child runs :func:`uifutures.worker.main` on that pipe
+with everything already imported, which is far cheaper than starting a new
+interpreter.
+
+"""
+
+import errno
+import imp
+import os
+import random
+import select
+import signal
+import sys
+import traceback
+import _multiprocessing
+from multiprocessing import reduction
+
+from uifutures import worker
+from uifutures.spawn import preload
+
+
+_original_main = None
+
+
+def _reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+
+
+def _reseed():
+    
+    # We (and so every child) have the random state that preloading left us
+    # with, so without this all workers would draw the same numbers.
+    random.seed()
+    numpy_random = sys.modules.get('numpy.random')
+    if numpy_random is not None:
+        numpy_random.seed()
+
+
+def _run_child(fd):
+    
+    _reseed()
+    
+    # Give the job the same clean __main__ that the_corner would. We hold onto
+    # the old one, as Python 2 clears a module's globals once it is freed.
+    global _original_main
+    _original_main = sys.modules['__main__']
+    sys.modules['__main__'] = imp.new_module('__main__')
+    sys.argv = ['uifutures.sandbox.the_corner', str(fd)]
+    
+    code = 0
+    try:
+        worker.main()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+
+def main():
+    
+    preload(os.environ.get('UIFUTURES_PRELOAD') or [])
+    
+    fd = int(sys.argv[1])
+    conn = _multiprocessing.Connection(fd)
+    
+    while True:
+        
+        # Wake up regularly to collect our dead children.
+        rlist, _, _ = select.select([conn], [], [], 1.0)
+        _reap()
+        if not rlist:
+            continue
+        
+        try:
+            msg = conn.recv()
+        except EOFError:
+            # The host is done with us; the workers carry on by themselves.
+            return
+        
+        if msg.get('type') != 'fork':
+            continue
+        
+        child_fd = reduction.recv_handle(conn)
+        pid = os.fork()
+        if not pid:
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            _run_child(child_fd)
+        
+        os.close(child_fd)
+        conn.send(dict(type='forked', pid=pid))
+
+
+if __name__ == '__main__':
+    main()
+
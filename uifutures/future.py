@@ -1,9 +1,61 @@
 from concurrent.futures import _base
+import collections
+import threading
+import time
 
 
 class Future(_base.Future):
     
-    def __init__(self, uuid):
+    def __init__(self, uuid, func_name=None):
         super(Future, self).__init__()
         self.uuid = uuid
+        self.func_name = func_name
+        
+        # Timestamps and resource usage of the job, filled in as it finishes.
+        # See uifutures.utils.get_durations.
+        self.stats = {}
+        
+        # How many times the host has retried the job after it failed.
+        self.retries = 0
+        
+        # Items yielded by a generator job which have not been consumed. They
+        # have their own condition, as waking the one for result() early
+        # makes it time out.
+        self._stream_items = collections.deque()
+        self._stream_cond = threading.Condition()
+        self.add_done_callback(self._stream_wake)
+    
+    def _stream_put(self, item):
+        with self._stream_cond:
+            self._stream_items.append(item)
+            self._stream_cond.notify_all()
+    
+    def _stream_wake(self, _):
+        with self._stream_cond:
+            self._stream_cond.notify_all()
+    
+    def stream(self, timeout=None):
+        """Iterate over the items yielded by a generator job as they arrive.
+        
+        This finishes once the job does, and raises its exception if it failed.
+        Items are consumed as they are iterated, so there should only be one
+        consumer. ``timeout`` applies to the wait for each item.
+        
+        """
+        while True:
+            with self._stream_cond:
+                end_time = None if timeout is None else time.time() + timeout
+                while not self._stream_items and not self.done():
+                    remaining = None if end_time is None else end_time - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise _base.TimeoutError()
+                    self._stream_cond.wait(remaining)
+                if self._stream_items:
+                    item = self._stream_items.popleft()
+                else:
+                    break
+            yield item
+        
+        # Raise any exception (or cancellation).
+        self.result()
 
@@ -1,30 +1,41 @@
 import sys
 import os
 import traceback
-from multiprocessing import connection
 import _multiprocessing
+import cPickle as pickle
+import collections
+import heapq
+import itertools
 import select
-import subprocess
+import socket
+import threading
 import time
 
 from uitools.qt import Qt, QtCore, QtGui
 
+from . import agent as agent_protocol
+from . import log
 from . import utils
+from .executor import DependencyFailed, JobTimeout
+from .metrics import Metrics
+from .recorder import Recorder
+from .store import PackageStore
+from .spawn import Spawner
+from .states import (INITED, QUEUED, BLOCKED, ACTIVE, RETRYING, COMPLETE,
+    FAILED, DEPENDENCY_FAILED, state_names)
 
 
 NotSet = object()
 
-INITED = 'INITED'
-QUEUED = 'QUEUED'
-BLOCKED = 'BLOCKED'
-DEPENDENCY_FAILED = 'DEPENDENCY_FAILED'
-ACTIVE = 'ACTIVE'
-COMPLETE = 'COMPLETE'
-FAILED = 'FAILED'
+# The slot for jobs which run in local workers (as opposed to an Agent).
+LOCAL = 'local'
 
-waiting_states = set((INITED, QUEUED, BLOCKED))
-failed_states = set((FAILED, DEPENDENCY_FAILED))
-finished_states = set((COMPLETE, FAILED, DEPENDENCY_FAILED))
+# How many heartbeats a worker may miss before we kill it.
+HEARTBEAT_GRACE = 3
+
+# Fields of a submit message which are particular to the job, as opposed to
+# its options (see Worker.options).
+_job_fields = frozenset(('type', 'uuid', 'name', 'depends_on', 'package', 'submitted', 'affinity_key'))
 
 # This will contain the single Host instance.
 host = None
@@ -38,169 +49,783 @@ class Host(QtCore.QThread):
     worker_message = QtCore.pyqtSignal([object, object, object])
     
     
-    def __init__(self, conn):
+    def __init__(self, conn, environ=None):
         super(Host, self).__init__()
         
+        # Our settings come from the environment, as we are started by the
+        # executor rather than called.
+        environ = os.environ if environ is None else environ
+        
         # Will be set to None if the connection is closed.
         self.conn = conn
         
         # Set by a "config" message from the executor.
         self.max_workers = None
+        self.profile_dir = environ.get('UIFUTURES_PROFILE_DIR')
         
-        # All workers we ever see, by uuid.
-        self.workers = {}
+        # If the executor is limiting outstanding jobs, we grant it a credit
+        # for every job which finishes. They are batched once per loop.
+        self.send_credits = False
+        self.pending_credits = 0
+        
+        # All workers we ever see, indexed by their id; ids are interned from
+        # the uuids the executor gives us.
+        self.workers = []
+        self.ids = {}
+        
+        # The options of submit messages (see Worker.options), each shared by
+        # all the jobs which have the same ones.
+        self.job_options = {}
         
         # All workers with are non of ACTIVE, FAILED, or DEPENDENCY_FAILED.
         self.unfinished_workers = []
         
+        # Large packages of jobs which are waiting are kept on disk.
+        threshold = environ.get('UIFUTURES_SPILL_THRESHOLD')
+        self.store = PackageStore(
+            dir_path=environ.get('UIFUTURES_SPILL_DIR'),
+            **({'threshold': int(threshold)} if threshold else {})
+        )
+        
+        # Creates worker processes, possibly ahead of time.
+        preload = environ.get('UIFUTURES_PRELOAD')
+        self.spawner = Spawner(
+            preload.split(',') if preload else None,
+            fork_server=bool(environ.get('UIFUTURES_FORK_SERVER')),
+        )
+        
+        # Heap of [when, seq, func, args] to call from the loop; cancelled
+        # ones have no func, and are not counted.
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.timer_count = 0
+        
+        # Run many jobs in each local worker process. Jobs wait a little for
+        # a process which ran their affinity_key, by their worker ids.
+        self.reuse_workers = False
+        self.affinity_delay = 0.5
+        self.affinity_waits = {}
+        
+        # Calls from other threads (e.g. "Try Again" in the UI), and a pipe to
+        # wake up our select for them.
+        self.calls = collections.deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        
+        # Readable when we have been signalled to dump our log; see main().
+        self.log_signal_fd = None
+        
+        # Remote agents, by their connection, and the socket they connect to
+        # if we are listening for them.
+        self.agents = {}
+        self.agent_listener = None
+        self.agent_authkey = None
+        
+        # Health counters, periodically written to a JSON file if configured.
+        self.metrics = Metrics(environ.get('UIFUTURES_METRICS_PATH'))
+        
+        # Every message we handle, for uifutures.replay.
+        trace_path = environ.get('UIFUTURES_TRACE_PATH')
+        self.recorder = Recorder(trace_path) if trace_path else None
+        
     def run(self):
         try:
             
+            loop_start = None
             while True:
                 
-                # Trigger state changes across all workers. We don't need to
-                # bother cascading state changes to earlier workers since
-                # dependencies can only be to previous workers.
+                self.schedule()
                 
-                active_count = sum(int(w.state == ACTIVE) for w in self.unfinished_workers)
-                for worker in self.unfinished_workers:
-                        
-                    # Don't bother poking anyone who is waiting if we have
-                    # already reached max_workers.
-                    allow_start = (
-                        self.max_workers is None or
-                        active_count < self.max_workers
-                    )
-                        
-                    old_state = worker.state
-                    worker.poke(allow_start)
-                    if worker.state != old_state:
-                        
-                        # Adjust active count.
-                        active_count -= int(old_state == ACTIVE)
-                        active_count += int(worker.state == ACTIVE)
-                        
-                        # Send state transition message.
-                        self.worker_message.emit(worker, "state_changed", dict(
-                            old=old_state,
-                            new=worker.state,
-                        ))
+                # Without local workers or agents, queued jobs can never run;
+                # schedule again so that those blocked on them fail too.
+                if self.max_workers == 0 and self.agent_listener is None and self.fail_unrunnable():
+                    continue
+                
+                # Top up the pre-spawned workers while we are still useful.
+                if self.conn is not None:
+                    self.spawner.refill()
                 
-                # Prune all complete workers.
-                self.unfinished_workers = [w for w in self.unfinished_workers if w.state not in finished_states]
+                if loop_start is not None:
+                    self.metrics.record_loop(time.time() - loop_start)
+                self.metrics.maybe_write(self)
                 
-                rlist = [worker.conn for worker in self.unfinished_workers if worker.conn is not None]
+                conn_workers = dict((w.conn, w) for w in self.unfinished_workers if w.conn is not None and w.agent is None)
+                rlist = conn_workers.keys()
                 if self.conn is not None:
                     rlist.append(self.conn)
+                rlist.extend(a.conn for a in self.agents.itervalues() if a.workers)
                 
-                if not rlist:
-                    
-                    # Wait for changes if there is something that failed, as
-                    # the user may hit "Retry".
-                    if any(x.state in failed_states for x in self.workers.itervalues()):
-                        time.sleep(0.25)
-                        continue
+                if not rlist and not self.timer_count:
                     
-                    # There is nothing left to do, and the executor is closed.
-                    break
+                    # Anything still waiting is waiting for an agent (or we
+                    # would have started it), so keep listening for one.
+                    if not any(w.state <= BLOCKED for w in self.unfinished_workers):
+                        
+                        # Nobody will use the pre-spawned workers or agents now.
+                        self.spawner.close()
+                        self.close_agents()
+                        
+                        # There is nothing left to do, and the executor is closed.
+                        # Unless something failed, as the user may hit "Retry".
+                        if not self.any_failed():
+                            break
+                
+                # Idle workers only speak up to handshake or die.
+                rlist.append(self.wakeup_r)
+                if self.log_signal_fd is not None:
+                    rlist.append(self.log_signal_fd)
+                rlist.extend(self.spawner.idle)
+                rlist.extend(x for x in self.agents if x not in rlist)
+                if self.agent_listener is not None:
+                    rlist.append(self.agent_listener)
                 
-                rlist, _, _ = select.select(rlist, [], [])
+                # Wake up in time for timers, or to write metrics.
+                rlist, _, _ = select.select(rlist, [], [], self.next_timeout())
+                loop_start = time.time()
                 for conn in rlist:
                     
+                    if conn is self.log_signal_fd:
+                        os.read(self.log_signal_fd, 4096)
+                        log.dump()
+                        continue
+                    
+                    if conn is self.wakeup_r:
+                        os.read(self.wakeup_r, 4096)
+                        while self.calls:
+                            func, args = self.calls.popleft()
+                            func(*args)
+                        continue
+                    
+                    if conn in self.spawner.idle:
+                        process = self.spawner.handle_idle(conn)
+                        if process is not None:
+                            self.metrics.record_spawn(process.ready_at - process.spawned_at)
+                        continue
+                    
+                    if conn is self.agent_listener:
+                        self.accept_agent()
+                        continue
+                    
+                    if conn in self.agents:
+                        self.handle_agent(self.agents[conn])
+                        continue
+                    
                     if conn is self.conn:
                         owner_type = 'executor'
+                        worker = None
                     else:
                         owner_type = 'worker'
-                        worker = [x for x in self.unfinished_workers if x.conn is conn][0]
+                        worker = conn_workers[conn]
                     
                     # Get a message, turning EOFs into shutdown messages.
                     # TODO: should these actually be "eof"?
                     try:
                         msg = conn.recv()
-                    except EOFError:
+                    except (EOFError, IOError):
                         msg = {'type': 'shutdown'}
                     
-                    type_ = msg.pop('type', None)
-                    # debug('Host: %r sent %r:\n%s', owner_type, type_, pprint.pformat(msg))
-                    
-                    # Send the message to methods on ourself, as well as to
-                    # the workers.
-                    handler = getattr(self, 'do_%s_%s' % (owner_type, type_ or 'unknown'), None)
-                    if owner_type == 'executor':
-                        if handler:
-                            handler(**msg)
-                        self.executor_message.emit(msg)
-                    else:
-                        if handler:
-                            handler(worker, **msg)
-                        self.worker_message.emit(worker, type_, msg)
+                    self.dispatch(owner_type, worker, msg)
         
         except:
             traceback.print_exc()
+            log.dump()
             QtGui.QApplication.exit(1)
         
         finally:
             if self.conn is not None:
                 self.conn.send(dict(type='shutdown'))
+            self.store.close()
+            self.spawner.close()
+            self.close_agents()
+            if self.recorder is not None:
+                self.recorder.close()
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
         
-        # debug("AT THE END")
-        if not any(w.state in failed_states for w in self.workers.itervalues()):
+        log.debug('Host: finished; %d jobs', len(self.workers))
+        if not self.any_failed():
             QtGui.QApplication.exit(0)
     
+    def schedule(self):
+        """Start whichever jobs can be, and prune finished ones."""
+        
+        # Trigger state changes across all workers. We don't need to
+        # bother cascading state changes to earlier workers since
+        # dependencies can only be to previous workers.
+        
+        # Retries which are due go back to INITED first.
+        self.run_timers()
+        
+        # Local jobs count against max_workers, and remote ones
+        # against the slots of their agent.
+        active_count = 0
+        busy_keys = set()
+        for agent in self.agents.itervalues():
+            agent.active = 0
+        for worker in self.unfinished_workers:
+            # Jobs give up their slot while they have subjobs, as
+            # they are most likely waiting for them.
+            if worker.state == ACTIVE and worker.subjobs <= 0:
+                if worker.agent is None:
+                    active_count += 1
+                    if self.reuse_workers:
+                        busy_keys.add(worker.affinity_key)
+                else:
+                    worker.agent.active += 1
+        
+        for worker in self.unfinished_workers:
+                
+            # Don't bother poking anyone who is waiting if we have
+            # already filled every slot.
+            slot = self.free_slot(active_count) if worker.state <= BLOCKED else None
+                
+            old_state = worker.state
+            worker.poke(self, slot, busy_keys)
+            if worker.state != old_state:
+                
+                # Adjust active count.
+                if worker.state == ACTIVE:
+                    if worker.agent is None:
+                        active_count += 1
+                        if self.reuse_workers:
+                            busy_keys.add(worker.affinity_key)
+                    else:
+                        worker.agent.active += 1
+                
+                # Send state transition message.
+                self.emit_state_changed(worker, old_state, worker.state)
+                
+                if worker.state == DEPENDENCY_FAILED:
+                    self.dependency_failed(worker)
+        
+        self.flush_credits()
+        
+        # Prune all complete workers.
+        self.unfinished_workers = [w for w in self.unfinished_workers if w.state < COMPLETE]
+    
+    def call_soon(self, func, *args):
+        """Call from the host's thread; safe to use from any thread."""
+        self.calls.append((func, args))
+        os.write(self.wakeup_w, '.')
+    
+    def call_later(self, delay, func, *args):
+        timer = [time.time() + delay, next(self.timer_seq), func, args]
+        heapq.heappush(self.timers, timer)
+        self.timer_count += 1
+        return timer
+    
+    def cancel_timer(self, timer):
+        if timer[2] is not None:
+            timer[2] = None
+            self.timer_count -= 1
+    
+    def run_timers(self):
+        now = time.time()
+        while self.timers and (self.timers[0][2] is None or self.timers[0][0] <= now):
+            _, _, func, args = heapq.heappop(self.timers)
+            if func is not None:
+                self.timer_count -= 1
+                func(*args)
+    
+    def next_timeout(self):
+        timeout = self.metrics.timeout()
+        if self.timers:
+            delay = max(0, self.timers[0][0] - time.time())
+            if timeout is None or delay < timeout:
+                timeout = delay
+        return timeout
+    
+    def free_slot(self, active_count):
+        """Where the next job should run: LOCAL, the agent with the most free
+        slots, or None if we are full."""
+        
+        if self.max_workers is None or active_count < self.max_workers:
+            return LOCAL
+        
+        best = None
+        for agent in self.agents.itervalues():
+            if agent.active < agent.slots and (best is None or agent.slots - agent.active > best.slots - best.active):
+                best = agent
+        return best
+    
+    def wait_for_affinity(self, worker, busy_keys):
+        """Should the job hold off on starting, since a process which ran its
+        affinity_key will be free soon?"""
+        
+        key = worker.affinity_key
+        if key is None or key not in busy_keys or self.spawner.has_affinity(key):
+            return False
+        
+        # Start the clock on the first time we say yes; the timer is dropped
+        # once it goes off.
+        if worker.id not in self.affinity_waits:
+            self.affinity_waits[worker.id] = self.call_later(self.affinity_delay, self.affinity_expired, worker.id)
+        return self.affinity_waits[worker.id] is not None
+    
+    def affinity_expired(self, id_):
+        self.affinity_waits[id_] = None
+    
+    def listen_for_agents(self, address, authkey):
+        self.agent_listener = agent_protocol.listen(address)
+        self.agent_authkey = authkey
+        self.send(dict(
+            type='listening',
+            address=self.agent_listener.getsockname(),
+        ))
+    
+    def accept_agent(self):
+        
+        try:
+            client = agent_protocol.accept(self.agent_listener)
+        except socket.error:
+            # They gave up on us already.
+            return
+        
+        # Authentication waits on the other end to answer (which a port
+        # scanner never will), so it can't hold up scheduling.
+        thread = threading.Thread(target=self._authenticate_agent, args=(client, ))
+        thread.daemon = True
+        thread.start()
+    
+    def _authenticate_agent(self, client):
+        try:
+            conn = agent_protocol.authenticate(client, self.agent_authkey)
+        except Exception:
+            # Bad authentication, or they gave up on us.
+            traceback.print_exc()
+            return
+        self.call_soon(self.add_agent, conn)
+    
+    def add_agent(self, conn):
+        # We may have stopped listening while they authenticated.
+        if self.agent_listener is None:
+            conn.close()
+            return
+        self.agents[conn] = Agent(conn)
+    
+    def handle_agent(self, agent):
+        
+        try:
+            msg = agent.conn.recv()
+        except (EOFError, IOError):
+            self.lose_agent(agent)
+            return
+        
+        type_ = msg.get('type')
+        if type_ == 'register':
+            agent.name = msg.get('name')
+            agent.slots = msg.get('slots', 0)
+            agent.codecs = tuple(msg.get('codecs') or ())
+            return
+        
+        # Everything else is from one of the workers it is running for us.
+        worker = agent.workers.get(msg.pop('uuid', None))
+        if worker is None:
+            return
+        if type_ in ('result', 'exception', 'shutdown'):
+            del agent.workers[worker.uuid]
+        self.dispatch('worker', worker, msg)
+    
+    def lose_agent(self, agent):
+        
+        del self.agents[agent.conn]
+        agent.conn.close()
+        
+        # Jobs it was running are failures, which may be retried.
+        for worker in agent.workers.values():
+            if worker.state < COMPLETE:
+                message = 'lost agent %s' % (agent.name or 'unknown')
+                self.dispatch('worker', worker, dict(
+                    type='exception',
+                    exception_name='RuntimeError',
+                    exception_message=message,
+                    package=pickle.dumps(dict(
+                        exception=RuntimeError(message),
+                    ), protocol=-1),
+                ))
+        agent.workers.clear()
+    
+    def close_agents(self):
+        for agent in self.agents.values():
+            agent.conn.close()
+        self.agents.clear()
+        if self.agent_listener is not None:
+            self.agent_listener.close()
+            self.agent_listener = None
+    
+    def any_failed(self):
+        return any(w.state >= FAILED for w in self.workers)
+    
+    def emit_state_changed(self, worker, old, new):
+        log.debug('Host: %s went from %s to %s', worker.uuid, state_names[old], state_names[new])
+        self.worker_message.emit(worker, 'state_changed', dict(
+            old=state_names[old],
+            new=state_names[new],
+        ))
+    
+    def dispatch(self, owner_type, worker, msg):
+        
+        type_ = msg.pop('type', None)
+        log.debug('Host: %s %s sent %s', owner_type, worker.uuid if worker is not None else '-', type_)
+        self.metrics.record_message(owner_type, type_)
+        
+        # Send the message to methods on ourself, as well as to
+        # the workers.
+        handler = getattr(self, 'do_%s_%s' % (owner_type, type_ or 'unknown'), None)
+        if owner_type == 'executor':
+            if handler:
+                handler(**msg)
+            self.executor_message.emit(msg)
+        else:
+            worker.last_seen = time.time()
+            if handler:
+                handler(worker, **msg)
+            self.worker_message.emit(worker, type_, msg)
+        
+        # After the handler, so that we have the config which enabled us.
+        if self.recorder is not None:
+            self.recorder.record(owner_type, worker, type_, msg)
+    
     def send(self, msg):
         if self.conn is not None:
             self.conn.send(msg)
     
-    def do_executor_config(self, max_workers=NotSet, **msg):
-        # debug('config: max_workers=%r', max_workers)
+    def send_for(self, worker, msg):
+        """Send a message about a job to whoever submitted it."""
+        
+        if worker.parent is None:
+            self.send(msg)
+            return
+        
+        # Subjobs report to the worker which submitted them, if it is still
+        # around to hear it.
+        parent = self.workers[worker.parent]
+        if parent.state == ACTIVE and parent.conn is not None:
+            msg = dict(msg)
+            msg['subjob'] = msg.pop('uuid')
+            parent.conn.send(msg)
+    
+    def job_finished(self, worker):
+        
+        # Only the first time; "Try Again" in the UI may finish it again.
+        if worker.credited:
+            return
+        worker.credited = True
+        
+        if worker.parent is not None:
+            self.workers[worker.parent].subjobs -= 1
+        elif self.send_credits:
+            self.pending_credits += 1
+    
+    def flush_credits(self):
+        if self.pending_credits:
+            self.send(dict(type='credit', count=self.pending_credits))
+            self.pending_credits = 0
+    
+    def dependency_failed(self, worker):
+        self.job_finished(worker)
+        self.send_for(worker, dict(
+            type='exception',
+            uuid=worker.uuid,
+            exception_name='DependencyFailed',
+            exception_message='dependency failed',
+            package=pickle.dumps(dict(
+                exception=DependencyFailed('dependency failed'),
+            ), protocol=-1),
+        ))
+    
+    def fail_unrunnable(self):
+        """Fail queued jobs, as there is nowhere to run them; returns how
+        many there were."""
+        
+        message = 'no local workers (max_workers=0) or agents to run it'
+        workers = [w for w in self.unfinished_workers if w.state == QUEUED]
+        for worker in workers:
+            self.emit_state_changed(worker, worker.state, FAILED)
+            worker.set_state(FAILED)
+            self.job_finished(worker)
+            self.send_for(worker, dict(
+                type='exception',
+                uuid=worker.uuid,
+                exception_name='RuntimeError',
+                exception_message=message,
+                package=pickle.dumps(dict(
+                    exception=RuntimeError(message),
+                ), protocol=-1),
+            ))
+        return len(workers)
+    
+    def do_executor_config(self, max_workers=NotSet, profile_dir=NotSet,
+        metrics_path=NotSet, metrics_interval=NotSet, credits=NotSet,
+        spill_threshold=NotSet, preload=NotSet, prespawn=NotSet, fork_server=NotSet,
+        agent_address=NotSet, agent_authkey=NotSet, reuse_workers=NotSet,
+        affinity_delay=NotSet, trace_path=NotSet, **msg
+    ):
+        log.debug('Host: config max_workers=%r', max_workers)
         if max_workers is not NotSet:
             self.max_workers = max_workers
+        if profile_dir is not NotSet:
+            self.profile_dir = profile_dir
+        if metrics_path is not NotSet:
+            self.metrics.path = metrics_path
+        if metrics_interval is not NotSet:
+            self.metrics.interval = metrics_interval
+        if credits is not NotSet:
+            self.send_credits = credits
+        if spill_threshold is not NotSet:
+            self.store.threshold = spill_threshold
+        if preload is not NotSet:
+            self.spawner.preload = preload
+        if prespawn is not NotSet:
+            self.spawner.prespawn = prespawn
+        if fork_server is not NotSet:
+            self.spawner.fork_server = fork_server
+        if agent_address is not NotSet:
+            self.listen_for_agents(agent_address, agent_authkey)
+        if reuse_workers is not NotSet:
+            self.reuse_workers = reuse_workers
+        if affinity_delay is not NotSet:
+            self.affinity_delay = affinity_delay
+        if trace_path is not NotSet:
+            if self.recorder is not None:
+                self.recorder.close()
+            self.recorder = Recorder(trace_path) if trace_path else None
     
-    def do_executor_submit(self, uuid, **msg):
+    def do_executor_submit(self, uuid, package, **msg):
+        self.add_job(uuid, package, msg)
+    
+    def add_job(self, uuid, package, msg, parent=None):
+        
+        id_ = len(self.workers)
+        self.ids[uuid] = id_
+        depends_on = tuple(self.ids[x] for x in msg.pop('depends_on', ()))
         
-        worker = Worker(self, uuid, **msg)
-        self.workers[uuid] = worker
+        worker = Worker(id_, uuid, depends_on, self.store.put(uuid, package), self.share_options(msg), msg)
+        for dep_id in depends_on:
+            dep = self.workers[dep_id]
+            if dep.dependents is None:
+                dep.dependents = []
+            dep.dependents.append(id_)
+        if parent is not None:
+            worker.parent = parent.id
+            parent.subjobs += 1
+        self.workers.append(worker)
         self.unfinished_workers.append(worker)
         self.worker_message.emit(worker, "new", msg)
     
+    def share_options(self, msg):
+        """Get the options of a submit message, as the dict shared by every
+        job with the same ones."""
+        
+        items = tuple(sorted(x for x in msg.iteritems() if x[0] not in _job_fields))
+        try:
+            return self.job_options.setdefault(items, dict(items))
+        except TypeError:
+            # Something unhashable; this job gets its own.
+            return dict(items)
+    
     def do_executor_shutdown(self, **msg):
-        # debug('Host: executor shut down')
+        log.debug('Host: executor shut down')
         self.conn = None
     
+    def do_worker_handshake(self, worker, pid, **msg):
+        worker.stats['spawned'] = time.time()
+        self.metrics.record_spawn(worker.stats['spawned'] - worker.stats['started'])
+        
+        # It is up now, so it should start its heartbeat.
+        self.stop_watchdog(worker)
+        self.check_watchdog(worker)
+    
+    def start_worker(self, worker, slot):
+        """Give the worker a process (or an agent), and send it the job."""
+        
+        log.debug('Host: starting %s on %s', worker.uuid, 'local' if slot is LOCAL else slot.name)
+        timer = self.affinity_waits.pop(worker.id, None)
+        if timer is not None:
+            self.cancel_timer(timer)
+        
+        if slot is not LOCAL:
+            worker.agent = slot
+            worker.conn = AgentChannel(slot, worker.uuid)
+            slot.workers[worker.uuid] = worker
+            worker.conn.send(self.recode_for_agent(worker.get_submit_msg(self.store), slot))
+            # It will relay a handshake once its worker is up.
+            worker.last_seen = None
+            self.check_watchdog(worker)
+            return
+        
+        process = self.spawner.acquire(worker.affinity_key)
+        worker.proc = process.proc
+        worker.conn = process.conn
+        
+        # A pre-spawned (or reused) process has already said hello, so tell
+        # everyone else what they missed. Until a process has, it may still be
+        # starting up (or preloading), so it isn't expected to heartbeat.
+        if process.ready_at is not None:
+            worker.stats['spawned'] = worker.stats['started']
+            worker.last_seen = time.time()
+            self.worker_message.emit(worker, 'handshake', dict(pid=process.pid))
+        else:
+            worker.last_seen = None
+        self.check_watchdog(worker)
+        
+        msg = worker.get_submit_msg(self.store)
+        if self.reuse_workers:
+            msg['reuse'] = True
+        worker.conn.send(msg)
+    
+    def recode_for_agent(self, msg, agent):
+        """Make sure the agent can decode a submit message's package, and
+        compress its result with a codec it has; the executor only negotiated
+        them with us."""
+        
+        # Everyone has zlib, but the agent may not have (or say that it has)
+        # anything.
+        fallback = 'zlib' if 'zlib' in agent.codecs else None
+        
+        codec = msg.get('package_codec')
+        if codec and codec not in agent.codecs:
+            package = utils.unpack(msg['package'], codec)
+            msg['package'], msg['package_codec'] = utils.pack(package, fallback)
+        if msg.get('result_codec') and msg['result_codec'] not in agent.codecs:
+            msg['result_codec'] = fallback
+        
+        return msg
+    
+    def release_process(self, worker):
+        """Keep the worker's process around for another job."""
+        self.spawner.release(worker.proc, worker.conn, worker.affinity_key)
+        worker.proc = None
+        worker.conn = None
+    
+    def check_watchdog(self, worker):
+        """Kill the worker if it is overdue or silent, else check it again
+        when it next could be."""
+        
+        worker.watchdog = None
+        
+        deadlines = []
+        job_timeout = worker.options.get('job_timeout')
+        if job_timeout:
+            deadlines.append((worker.stats['started'] + job_timeout, 'ran for more than %ss' % job_timeout))
+        interval = worker.options.get('heartbeat_interval')
+        if interval and worker.last_seen is not None:
+            deadlines.append((worker.last_seen + HEARTBEAT_GRACE * interval, 'silent for more than %ss' % (HEARTBEAT_GRACE * interval)))
+        if not deadlines:
+            return
+        
+        when, reason = min(deadlines)
+        now = time.time()
+        if when > now:
+            worker.watchdog = self.call_later(when - now, self.check_watchdog, worker)
+        else:
+            self.kill_worker(worker, reason)
+    
+    def stop_watchdog(self, worker):
+        if worker.watchdog is not None:
+            self.cancel_timer(worker.watchdog)
+            worker.watchdog = None
+    
+    def kill_worker(self, worker, reason):
+        
+        if worker.agent is not None:
+            worker.conn.send(dict(type='kill'))
+            worker.agent.workers.pop(worker.uuid, None)
+            worker.agent = None
+        else:
+            if worker.proc is not None:
+                try:
+                    worker.proc.kill()
+                except OSError:
+                    pass
+            if worker.conn is not None:
+                worker.conn.close()
+        worker.conn = None
+        
+        message = 'job killed; %s' % reason
+        self.dispatch('worker', worker, dict(
+            type='exception',
+            exception_name='JobTimeout',
+            exception_message=message,
+            package=pickle.dumps(dict(
+                exception=JobTimeout(message),
+            ), protocol=-1),
+        ))
+    
     def do_worker_notify(self, worker, **msg):
         msg.setdefault('icon', worker.icon)
         msg.setdefault('title', worker.name)
-        utils.notify(**msg)
+        self.notify(**msg)
+    
+    def notify(self, **kwargs):
+        utils.notify(**kwargs)
+    
+    def _finish_stats(self, worker, msg):
+        worker.init_stats()
+        worker.stats.update(msg.get('stats') or {})
+        worker.stats['finished'] = time.time()
+        msg['stats'] = dict(worker.stats)
+        if self.profile_dir and 'profile' in msg:
+            utils.save_profile(self.profile_dir, worker.uuid, msg['profile'])
     
-    def do_worker_result(self, worker, **msg):
+    def do_worker_submit(self, worker, subjob, package, **msg):
+        self.add_job(subjob, package, msg, parent=worker)
+    
+    def do_worker_yield(self, worker, **msg):
         
-        self.worker_message.emit(worker, 'state_changed', dict(
-            old=worker.state,
-            new=COMPLETE
-        ))
-        worker.state = COMPLETE
+        msg['type'] = 'yield'
+        msg['uuid'] = worker.uuid
+        self.send_for(worker, msg)
+        
+        # Acknowledge in batches of half the worker's window so that it never
+        # has to stop and wait for us if we are keeping up.
+        window = worker.options.get('stream_window')
+        if window:
+            worker.unacked += 1
+            if worker.unacked >= max(1, window // 2):
+                worker.conn.send(dict(type='ack', count=worker.unacked))
+                worker.unacked = 0
+    
+    def do_worker_result(self, worker, reusable=False, **msg):
+        
+        self.stop_watchdog(worker)
+        if reusable:
+            self.release_process(worker)
+        self.emit_state_changed(worker, worker.state, COMPLETE)
+        worker.set_state(COMPLETE)
+        self.job_finished(worker)
+        
+        # There is no retrying a success, so we are done with the package.
+        worker.release_package(self.store)
         
         # Forward the message.
+        self._finish_stats(worker, msg)
         msg['type'] = 'result'
         msg['uuid'] = worker.uuid
-        self.send(msg)
+        self.send_for(worker, msg)
     
-    def do_worker_exception(self, worker, **msg):
+    def do_worker_exception(self, worker, reusable=False, **msg):
         
-        self.worker_message.emit(worker, 'state_changed', dict(
-            old=worker.state,
-            new=FAILED
-        ))
-        worker.state = FAILED
+        self.stop_watchdog(worker)
+        if reusable:
+            self.release_process(worker)
+        
+        if worker.retry_count < worker.options.get('retries', 0):
+            self.retry_later(worker, msg)
+            return
+        
+        self.emit_state_changed(worker, worker.state, FAILED)
+        worker.set_state(FAILED)
+        self.job_finished(worker)
         
         # Forward the message.
+        self._finish_stats(worker, msg)
         msg['type'] = 'exception'
         msg['uuid'] = worker.uuid
-        self.send(msg)
+        self.send_for(worker, msg)
         msg.setdefault('exception_name', 'Unknown')
         msg.setdefault('exception_message', 'unknown')
         msg.setdefault('exception_traceback', '')
-        utils.notify(
+        self.notify(
             title='Job Failed: %s' % (worker.name or 'Untitled'),
             message='{exception_name}: {exception_message}\n{exception_traceback}'.format(**msg),
             sticky=True,
@@ -210,88 +835,283 @@ class Host(QtCore.QThread):
     def do_worker_shutdown(self, worker):
         
         # It wasn't done it's job.
-        if worker.state not in finished_states:
+        if worker.state < COMPLETE:
+            state_name = state_names[worker.state]
             self.do_worker_exception(worker, **dict(
                 type='exception',
                 exception_name='RuntimeError',
-                exception_message='worker shutdown unexpectedly; was %r' % worker.state,
-                exception=RuntimeError('worker shutdown unexpectedly; was %r' % worker.state),
+                exception_message='worker shutdown unexpectedly; was %r' % state_name,
+                exception=RuntimeError('worker shutdown unexpectedly; was %r' % state_name),
             ))
+    
+    def retry_later(self, worker, msg):
+        """Hold onto a failed job, and run it again after a backoff."""
+        
+        delay = worker.options.get('retry_backoff', 1.0) * 2 ** worker.retry_count
+        
+        self.emit_state_changed(worker, worker.state, RETRYING)
+        worker.set_state(RETRYING)
+        
+        # We don't want to hear from this attempt again.
+        if worker.agent is not None:
+            worker.agent.workers.pop(worker.uuid, None)
+        elif worker.conn is not None:
+            worker.conn.close()
+        worker.conn = None
+        worker.agent = None
+        
+        retry_msg = dict(
+            attempt=worker.retry_count + 1,
+            retries=worker.options['retries'],
+            delay=delay,
+            exception_name=msg.get('exception_name', 'Unknown'),
+            exception_message=msg.get('exception_message', 'unknown'),
+        )
+        self.worker_message.emit(worker, 'retry', retry_msg)
+        retry_msg['type'] = 'retry'
+        retry_msg['uuid'] = worker.uuid
+        self.send_for(worker, retry_msg)
+        
+        self.call_later(delay, self.retry, worker)
+    
+    def retry(self, worker):
+        
+        # Back to the front of the line for it, unless it never left.
+        if worker.state >= COMPLETE:
+            self.unfinished_workers.insert(0, worker)
+        worker.retry()
+        
+        # To the end of the line for anything that failed because of it. We
+        # must maintain the ordering of dependencies in the queue.
+        to_reset = []
+        ids = list(worker.dependents or ())
+        while ids:
+            other = self.workers[ids.pop()]
+            if other.state == DEPENDENCY_FAILED:
+                other.set_state(INITED)
+                to_reset.append(other)
+                ids.extend(other.dependents or ())
+        to_reset.sort(key=lambda w: w.id)
+        self.unfinished_workers.extend(to_reset)
 
 
 class Worker(object):
     
-    def __init__(self, host, uuid, **submit_msg):
+    """The host's record of a single job.
+    
+    There may be a great many of these, so they are kept small: ids and
+    states are small ints, the package is held by the host's store, the
+    options of the submit message are shared with other jobs which have the
+    same ones, and stats and dependents are only created when needed.
+    
+    """
+    
+    __slots__ = (
+        'id',
+        'uuid',
+        'name',
+        'icon',
+        'options',
+        'affinity_key',
+        'package',
+        'depends_on',
+        'dependents',
+        'parent',
+        'subjobs',
+        'credited',
+        'state',
+        'conn',
+        'proc',
+        'agent',
+        'retry_count',
+        'unacked',
+        'last_seen',
+        'watchdog',
+        'submitted',
+        'received',
+        'blocked',
+        'blocked_since',
+        'stats',
+    )
+    
+    def __init__(self, id_, uuid, depends_on, package, options, msg):
         
-        self.host = host
+        self.id = id_
         self.uuid = uuid
-        self.name = submit_msg.get('name') or submit_msg.get('func_name') or uuid
-        self.icon = utils.icon(submit_msg.get('icon') or 'fatcow/gear_in')
-
-        submit_msg['type'] = 'submit'
-        submit_msg['uuid'] = uuid
-        self.submit_msg = submit_msg
+        
+        # Everything in the submit message which isn't particular to us (see
+        # _job_fields); this is shared, so must not be modified. Most jobs
+        # are named after their function, which we can share too.
+        self.options = options
+        func_name = options.get('func_name')
+        name = msg.get('name') or func_name
+        self.name = (func_name if name == func_name else name) or uuid
+        self.icon = intern(utils.icon(options.get('icon') or 'fatcow/gear_in'))
+        self.affinity_key = msg.get('affinity_key')
+        
+        # The package is a reference from the host's store (possibly to
+        # disk), and is kept after we start in case we are retried.
+        self.package = package
+        self.depends_on = depends_on
+        # Ids of later workers which depend on us, if any do.
+        self.dependents = None
+        
+        # The id of the worker which submitted us, and how many of our own
+        # subjobs are unfinished.
+        self.parent = None
+        self.subjobs = 0
+        
+        # If we have given back our submit credit (or told our parent we are
+        # done), which we only ever do once.
+        self.credited = False
         
         self.state = INITED
         self.conn = None
-        self.depends_on = submit_msg['depends_on']
+        self.proc = None
+        self.agent = None
         
         self.retry_count = 0
+        
+        # Streamed items we have forwarded but not acknowledged.
+        self.unacked = 0
+        
+        # When we last heard from the job, and the timer to check on it.
+        self.last_seen = None
+        self.watchdog = None
+        
+        # What we know before we start, and the total time spent waiting on
+        # dependencies; they go into stats once we start.
+        self.submitted = msg.get('submitted')
+        self.received = time.time()
+        self.blocked = 0
+        self.blocked_since = None
+        
+        # Timestamps of each phase; see uifutures.utils.get_durations.
+        self.stats = None
     
-    def poke(self, allow_start):
-                    
-        if self.state not in waiting_states:
+    def init_stats(self):
+        """Create our stats (if we haven't), for when we start or finish."""
+        if self.stats is None:
+            self.stats = dict(submitted=self.submitted, received=self.received)
+            if self.blocked:
+                self.stats['blocked'] = self.blocked
+    
+    def set_state(self, state):
+        
+        # Keep track of the total time spent waiting for dependencies.
+        if self.state == BLOCKED and state != BLOCKED:
+            self.blocked += time.time() - self.blocked_since
+        elif state == BLOCKED and self.state != BLOCKED:
+            self.blocked_since = time.time()
+        
+        self.state = state
+    
+    def poke(self, host, slot, busy_keys=()):
+        
+        if self.state > BLOCKED:
             return
         
-        if any(self.host.workers[x].state in failed_states for x in self.depends_on):
-            self.state = DEPENDENCY_FAILED
+        workers = host.workers
+        blocked = False
+        for id_ in self.depends_on:
+            state = workers[id_].state
+            if state >= FAILED:
+                self.set_state(DEPENDENCY_FAILED)
+                return
+            blocked = blocked or state < COMPLETE
+        
+        if blocked:
+            self.set_state(BLOCKED)
             return
         
-        if any(self.host.workers[x].state not in finished_states for x in self.depends_on):
-            self.state = BLOCKED
+        if slot is None:
+            self.set_state(QUEUED)
             return
         
-        if not allow_start:
-            self.state = QUEUED
+        # Now that we are ready, we may hold off for a process which ran our
+        # affinity_key (see Host.wait_for_affinity).
+        if slot is LOCAL and host.wait_for_affinity(self, busy_keys):
+            self.set_state(QUEUED)
             return
         
         # Running! Finally...
-        self.state = ACTIVE
-        
-        # Launch a worker, and tell it to connect to us.
-        self.conn, child_conn = connection.Pipe()
-        cmd = ['python', '-m', 'uifutures.sandbox.the_corner', str(child_conn.fileno())]
-        self.proc = subprocess.Popen(cmd)
-        child_conn.close()
-        
-        # Forward the submission.
-        self.conn.send(self.submit_msg)
+        self.set_state(ACTIVE)
+        self.init_stats()
+        self.stats['started'] = time.time()
+        host.start_worker(self, slot)
+    
+    def get_submit_msg(self, store):
+        msg = dict(self.options)
+        msg['type'] = 'submit'
+        msg['uuid'] = self.uuid
+        msg['name'] = self.name
+        msg['submitted'] = self.submitted
+        if self.affinity_key is not None:
+            msg['affinity_key'] = self.affinity_key
+        msg['package'] = store.get(self.package)
+        return msg
+    
+    def release_package(self, store):
+        if self.package is not None:
+            store.discard(self.package)
+            self.package = None
     
     def retry(self):
         
         self.retry_count += 1
         
-        # Reset our connection.
+        # Reset our connection and stats.
         self.conn = None
+        self.agent = None
+        self.unacked = 0
+        self.subjobs = 0
+        self.received = time.time()
+        self.blocked = 0
+        self.stats = None
         
-        # Back to the front of the line for us.
-        self.state = INITED
-        self.host.unfinished_workers.insert(0, self)
-        
-        for worker in self.host.workers.values():
-            if worker.state == DEPENDENCY_FAILED and self.uuid in worker.depends_on:
-                
-                # To the end of the line for anything that depended on us.
-                # We must maintain the ordering of dependencies in the queue.
-                worker.state = INITED
-                self.host.unfinished_workers.append(worker)
+        self.set_state(INITED)
+
+
+class Agent(object):
+    
+    """A :mod:`uifutures.agent` which has connected to offer us slots."""
+    
+    __slots__ = ('conn', 'name', 'slots', 'codecs', 'active', 'workers')
+    
+    def __init__(self, conn):
+        self.conn = conn
+        # Set when it registers.
+        self.name = None
+        self.slots = 0
+        self.codecs = ()
+        self.active = 0
+        # Workers it is running for us, by uuid.
+        self.workers = {}
+
+
+class AgentChannel(object):
+    
+    """Stands in for the pipe of a worker running on an agent."""
+    
+    __slots__ = ('agent', 'uuid')
+    
+    def __init__(self, agent, uuid):
+        self.agent = agent
+        self.uuid = uuid
+    
+    def send(self, msg):
+        msg = dict(msg)
+        msg['uuid'] = self.uuid
+        self.agent.conn.send(msg)
 
 
 class WorkerWidget(QtGui.QFrame):
     
-    def __init__(self, worker, **extra):
+    def __init__(self, host, worker, **extra):
         super(WorkerWidget, self).__init__()
+        self._host = host
         self._worker = worker
+        self._retrying = None
         self._setup_ui()
         
         self.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -338,6 +1158,16 @@ class WorkerWidget(QtGui.QFrame):
         self._button_layout = QtGui.QVBoxLayout()
         main_layout.addLayout(self._button_layout)
         self._buttons = []
+        
+        # Subjobs go under us.
+        self._subjobs = QtGui.QWidget()
+        self._subjobs.setLayout(QtGui.QVBoxLayout())
+        self._subjobs.layout().setContentsMargins(0, 0, 0, 0)
+        self._subjobs.layout().setSpacing(0)
+        main_layout.addWidget(self._subjobs)
+    
+    def add_subjob(self, widget):
+        self._subjobs.layout().addWidget(widget)
     
     def _empty_buttons(self):
         for x in self._buttons:
@@ -345,7 +1175,7 @@ class WorkerWidget(QtGui.QFrame):
             x.destroy()
         self._main_layout.removeItem(self._button_layout)
         self._button_layout = QtGui.QHBoxLayout()
-        self._main_layout.addLayout(self._button_layout)
+        self._main_layout.insertLayout(self._main_layout.indexOf(self._subjobs), self._button_layout)
         self._buttons = []
     
     def _add_button(self, x):
@@ -354,8 +1184,19 @@ class WorkerWidget(QtGui.QFrame):
     
     def _on_context_menu(self, point):
         menu = QtGui.QMenu()
-        menu.addAction("Test Context Menu")
+        action = menu.addAction("Show Stats")
+        action.triggered.connect(self._show_stats)
         menu.exec_(self.mapToGlobal(point))
+    
+    def _show_stats(self):
+        stats = self._worker.stats or {}
+        lines = ['%s: %.3fs' % x for x in utils.get_durations(stats)]
+        for key, format_ in (('user_time', 'user CPU: %.3fs'), ('system_time', 'system CPU: %.3fs')):
+            if key in stats:
+                lines.append(format_ % stats[key])
+        if 'max_rss' in stats:
+            lines.append('max RSS: %.1f MB' % (stats['max_rss'] / 1048576.0))
+        QtGui.QMessageBox.information(self, 'Stats: %s' % self._worker.name, '\n'.join(lines) or 'No stats yet.')
         
     def _handle_message(self, type_, **msg):
         handler = getattr(self, '_do_%s' % type_, None)
@@ -366,7 +1207,6 @@ class WorkerWidget(QtGui.QFrame):
     def _do_state_changed(self, **msg):
         # old = msg['old'].lower()
         new = msg['new'].lower()
-        # debug('Host: %s transition from %s to %s', self._worker.uuid, old, new)
         handlers = [
             # getattr(self, '_do_transition_from_{old}'.format(old=old), None),
             # getattr(self, '_do_transition_from_{old}_to_{new}'.format(old=old, new=new), None),
@@ -387,9 +1227,19 @@ class WorkerWidget(QtGui.QFrame):
         
     def _do_transition_to_active(self, **msg):
         self._status.setText('Starting...')
+        
+        # This may be a retry.
+        self._status.setStyleSheet('')
+        self._progress.setRange(0, 0)
     
-    def _do_handshake(self, pid, **msg):
-        self._status.setText('Running as PID %d' % pid)
+    def _do_retry(self, attempt, retries, delay, **msg):
+        self._retrying = (attempt, retries, delay)
+    
+    def _do_handshake(self, pid, agent=None, **msg):
+        if agent:
+            self._status.setText('Running on %s as PID %d' % (agent, pid))
+        else:
+            self._status.setText('Running as PID %d' % pid)
         
     def _do_result(self, **msg):
         self._status.setText('Done.')
@@ -399,6 +1249,15 @@ class WorkerWidget(QtGui.QFrame):
     def _do_exception(self, exception_name, exception_message, **msg):
         self._set_failure('%s: %s' % (exception_name, exception_message))
         
+        # The host will try again on its own.
+        if self._retrying:
+            attempt, retries, delay = self._retrying
+            self._retrying = None
+            self._status.setText('%s: %s\nRetry %d of %d in %.1fs...' % (
+                exception_name, exception_message, attempt, retries, delay,
+            ))
+            return
+        
         self._empty_buttons()
         
         button = QtGui.QToolButton()
@@ -418,7 +1277,7 @@ class WorkerWidget(QtGui.QFrame):
     def _retry(self):
         self._status.setText('Resubmitting...')
         self._status.setStyleSheet('')
-        self._worker.retry()
+        self._host.call_soon(self._host.retry, self._worker)
         self._empty_buttons()
         
     def _do_transition_to_dependency_failed(self, **msg):
@@ -463,6 +1322,7 @@ class Window(QtGui.QMainWindow):
         self._setup_ui()
         self._uuid_to_widget = {}
         
+        self._host = host
         host.worker_message.connect(self._on_worker_message)
     
     def _setup_ui(self):
@@ -482,9 +1342,12 @@ class Window(QtGui.QMainWindow):
         
         # This is a new worker.
         if worker.uuid not in self._uuid_to_widget:
-            widget = WorkerWidget(worker, type=type_, **msg)
+            widget = WorkerWidget(self._host, worker, type=type_, **msg)
             self._uuid_to_widget[worker.uuid] = widget
-            self._layout.addWidget(widget)
+            if worker.parent is None:
+                self._layout.addWidget(widget)
+            else:
+                self._uuid_to_widget[self._host.workers[worker.parent].uuid].add_subjob(widget)
         
         self._uuid_to_widget[worker.uuid]._handle_message(type_, **msg)
             
@@ -501,10 +1364,15 @@ def main():
     conn.send(dict(
         type='handshake',
         pid=os.getpid(),
+        codecs=utils.available_codecs,
     ))
 
     host = Host(conn)
     
+    # Qt's event loop holds the main thread (where Python runs signal
+    # handlers) for as long as the UI is idle, so we dump from our thread.
+    host.log_signal_fd = log.install_signal_handler(wakeup=True)
+    
     app = QtGui.QApplication([])
     app.setApplicationName('Futures Host')
     app.setWindowIcon(QtGui.QIcon(utils.icon('fatcow/road_sign')))
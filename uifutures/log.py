@@ -0,0 +1,163 @@
+"""Leveled debug logging into an in-memory ring buffer.
+
+Logging a message only appends a ``(time, thread, level, msg, args)`` tuple
+to a bounded :class:`collections.deque` (which is atomic, so there is no lock
+to take), and formatting is put off until the buffer is dumped; that is
+cheap enough to leave on in the hot paths. The buffer is dumped to stderr
+when the host or a worker dies, or on ``SIGUSR1`` once
+:func:`install_signal_handler` has been called (which the host does in a
+way that works while the UI is busy)::
+
+    kill -USR1 <pid of the host>
+
+Since the args are held until they are dumped (or pushed out of the buffer),
+pass small values (uuids, names, numbers) rather than whole messages.
+
+Controlled by the environment, which the host and workers inherit:
+
+- ``UIFUTURES_LOG_LEVEL``: the lowest level which is recorded (default
+  ``DEBUG``);
+- ``UIFUTURES_LOG_SIZE``: how many records are kept (default 10000);
+- ``UIFUTURES_LOG_ECHO``: the lowest level which is also written to stderr
+  as it happens (default ``WARNING``).
+
+"""
+
+import collections
+import fcntl
+import os
+import signal
+import sys
+import thread
+import time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR',
+}
+
+
+def _get_level(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    if value.isdigit():
+        return int(value)
+    for level, level_name in level_names.iteritems():
+        if level_name == value.upper():
+            return level
+    raise ValueError('unknown log level %r in %s' % (value, name))
+
+
+level = _get_level('UIFUTURES_LOG_LEVEL', DEBUG)
+echo_level = _get_level('UIFUTURES_LOG_ECHO', WARNING)
+
+_start = time.time()
+_buffer = collections.deque(maxlen=int(os.environ.get('UIFUTURES_LOG_SIZE') or 10000))
+
+
+def enabled_for(level_):
+    """Is anything logged at this level? Use this to guard building args
+    which are expensive on their own."""
+    return level_ >= level
+
+
+def log(level_, msg, *args):
+    if level_ < level:
+        return
+    record = (time.time(), thread.get_ident(), level_, msg, args)
+    _buffer.append(record)
+    if level_ >= echo_level:
+        sys.stderr.write(format_record(record, {}) + '\n')
+
+
+def debug(msg, *args):
+    # log() inlined, as this is the one in the hot paths.
+    if DEBUG >= level:
+        record = (time.time(), thread.get_ident(), DEBUG, msg, args)
+        _buffer.append(record)
+        if DEBUG >= echo_level:
+            sys.stderr.write(format_record(record, {}) + '\n')
+
+
+def info(msg, *args):
+    log(INFO, msg, *args)
+
+
+def warning(msg, *args):
+    log(WARNING, msg, *args)
+
+
+def error(msg, *args):
+    log(ERROR, msg, *args)
+
+
+def format_record(record, thread_ids):
+    """Format one record; ``thread_ids`` maps thread idents to the short
+    numbers we print instead, and is added to as new threads are seen."""
+    
+    time_, ident, level_, msg, args = record
+    if args:
+        try:
+            msg = msg % args
+        except Exception as e:
+            msg = '%s %% %r (%s: %s)' % (msg, args, e.__class__.__name__, e)
+    
+    thread_id = thread_ids.setdefault(ident, len(thread_ids))
+    return '# %10.3f %3d %-7s %s' % ((time_ - _start) * 1000, thread_id, level_names.get(level_, level_), msg)
+
+
+def records():
+    """A snapshot of the buffer, oldest first."""
+    # Copying a deque doesn't release the GIL, so nobody can append mid-copy.
+    return list(_buffer)
+
+
+def dump(fh=None, clear=True):
+    """Write the buffered records to the given file (or stderr), with time
+    since the previous record for each."""
+    
+    fh = fh or sys.stderr
+    snapshot = records()
+    if clear:
+        _buffer.clear()
+    
+    thread_ids = {}
+    last = snapshot[0][0] if snapshot else None
+    fh.write('# uifutures log for pid %d: %d records\n' % (os.getpid(), len(snapshot)))
+    for record in snapshot:
+        fh.write('%s (+%.3f)\n' % (format_record(record, thread_ids), (record[0] - last) * 1000))
+        last = record[0]
+    fh.flush()
+
+
+def install_signal_handler(signum=signal.SIGUSR1, wakeup=False):
+    """Dump the buffer whenever we get the given signal; must be called from
+    the main thread.
+    
+    Python only runs signal handlers once the main thread runs Python code,
+    which it may not do for a long while if it is in a C event loop (i.e.
+    Qt's). With ``wakeup``, the signal (or any other which Python handles) is
+    instead written to a pipe by :func:`signal.set_wakeup_fd`, and the read end
+    is returned; another thread should select on it, and read from it and
+    call :func:`dump` once it is readable.
+    
+    """
+    
+    if not wakeup:
+        signal.signal(signum, lambda signum, frame: dump())
+        return
+    
+    read_fd, write_fd = os.pipe()
+    fcntl.fcntl(write_fd, fcntl.F_SETFL, fcntl.fcntl(write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(write_fd)
+    signal.signal(signum, lambda signum, frame: None)
+    return read_fd
@@ -0,0 +1,153 @@
+import fcntl
+import json
+import os
+import struct
+import termios
+import time
+
+from .states import state_names
+
+
+# Upper bounds (in seconds) of the spawn latency histogram buckets.
+spawn_buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+def get_backlog(conn):
+    """Number of bytes waiting to be read from the given connection, or None
+    if that can't be determined."""
+    try:
+        buf = fcntl.ioctl(conn.fileno(), termios.FIONREAD, struct.pack('i', 0))
+    except (IOError, OSError, ValueError):
+        return
+    return struct.unpack('i', buf)[0]
+
+
+class Metrics(object):
+    
+    """Health counters for the :class:`~uifutures.host.Host` scheduler.
+    
+    The host feeds this as it runs, and a JSON snapshot is periodically
+    written (atomically) to ``path`` for monitoring to pick up.
+    
+    """
+    
+    def __init__(self, path=None, interval=5.0):
+        
+        self.path = path
+        self.interval = interval
+        
+        self.start_time = self.last_snapshot_time = time.time()
+        
+        # By "owner.type", e.g. "worker.progress"; totals, and those since the
+        # last snapshot.
+        self.messages = {}
+        self._recent_messages = {}
+        
+        self.loop_count = 0
+        self.loop_time = 0.0
+        self.loop_time_max = 0.0
+        self._recent_loop_count = 0
+        self._recent_loop_time = 0.0
+        
+        self.spawn_histogram = [0] * (len(spawn_buckets) + 1)
+        self.spawn_count = 0
+        self.spawn_time = 0.0
+    
+    def timeout(self):
+        """How long the host may block before it should write a snapshot."""
+        if not self.path:
+            return
+        return max(0, self.last_snapshot_time + self.interval - time.time())
+    
+    def record_message(self, owner_type, type_):
+        key = '%s.%s' % (owner_type, type_)
+        self.messages[key] = self.messages.get(key, 0) + 1
+        self._recent_messages[key] = self._recent_messages.get(key, 0) + 1
+    
+    def record_loop(self, duration):
+        self.loop_count += 1
+        self.loop_time += duration
+        self.loop_time_max = max(self.loop_time_max, duration)
+        self._recent_loop_count += 1
+        self._recent_loop_time += duration
+    
+    def record_spawn(self, duration):
+        self.spawn_count += 1
+        self.spawn_time += duration
+        for i, bound in enumerate(spawn_buckets):
+            if duration <= bound:
+                self.spawn_histogram[i] += 1
+                break
+        else:
+            self.spawn_histogram[-1] += 1
+    
+    def snapshot(self, host):
+        
+        now = time.time()
+        elapsed = max(1e-6, now - self.last_snapshot_time)
+        
+        states = {}
+        for worker in host.unfinished_workers:
+            name = state_names[worker.state]
+            states[name] = states.get(name, 0) + 1
+        
+        conns = [w.conn for w in host.unfinished_workers if w.conn is not None and w.agent is None]
+        if host.conn is not None:
+            conns.append(host.conn)
+        backlogs = [x for x in (get_backlog(c) for c in conns) if x is not None]
+        
+        snapshot = dict(
+            time=now,
+            pid=os.getpid(),
+            uptime=now - self.start_time,
+            workers=len(host.workers),
+            states=states,
+            messages=dict(self.messages),
+            message_rates=dict((k, v / elapsed) for k, v in self._recent_messages.iteritems()),
+            loop=dict(
+                count=self.loop_count,
+                mean=self.loop_time / self.loop_count if self.loop_count else None,
+                max=self.loop_time_max,
+                recent_mean=self._recent_loop_time / self._recent_loop_count if self._recent_loop_count else None,
+                recent_rate=self._recent_loop_count / elapsed,
+            ),
+            backlog=dict(
+                total=sum(backlogs),
+                max=max(backlogs) if backlogs else 0,
+            ),
+            agents=dict(
+                count=len(host.agents),
+                slots=sum(a.slots for a in host.agents.itervalues()),
+                active=sum(len(a.workers) for a in host.agents.itervalues()),
+            ),
+            spilled=dict(
+                count=host.store.spilled_count,
+                bytes=host.store.spilled_bytes,
+            ),
+            spawn=dict(
+                count=self.spawn_count,
+                mean=self.spawn_time / self.spawn_count if self.spawn_count else None,
+                buckets=list(spawn_buckets) + [None],
+                histogram=list(self.spawn_histogram),
+            ),
+        )
+        
+        self.last_snapshot_time = now
+        self._recent_messages = {}
+        self._recent_loop_count = 0
+        self._recent_loop_time = 0.0
+        
+        return snapshot
+    
+    def maybe_write(self, host):
+        """Write a snapshot if one is due."""
+        
+        if not self.path or self.timeout():
+            return
+        
+        encoded = json.dumps(self.snapshot(host), sort_keys=True)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            fh.write(encoded + '\n')
+        os.rename(tmp_path, self.path)
+
@@ -0,0 +1,94 @@
+"""Records the messages a host handles, for :mod:`uifutures.replay`.
+
+A trace is a short header, then one marshalled ``(time, owner_type, uuid,
+type, msg)`` tuple per message. Times are seconds since the trace started
+(and never go backwards), and ``uuid`` is that of the job the message is
+from, or None for messages from the executor. Payloads are replaced by their length, so traces stay small and
+don't hold on to anyone's data.
+
+"""
+
+import marshal
+import time
+
+
+MAGIC = 'UIFUTURES-TRACE-2\n'
+
+# Keys whose values are replaced by their length, and those which are dropped.
+_sized_keys = ('package', 'profile')
+_dropped_keys = ('agent_authkey', )
+
+
+def _strip(msg):
+    
+    out = {}
+    for key, value in msg.iteritems():
+        if key in _dropped_keys:
+            continue
+        if key in _sized_keys and isinstance(value, basestring):
+            value = len(value)
+        out[key] = value
+    
+    # Anything marshal can't handle (which shouldn't be in a message anyways)
+    # is kept as its repr.
+    try:
+        marshal.dumps(out)
+    except ValueError:
+        for key, value in out.items():
+            try:
+                marshal.dumps(value)
+            except ValueError:
+                out[key] = repr(value)
+    
+    return out
+
+
+class Recorder(object):
+    
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, 'wb')
+        self._fh.write(MAGIC)
+        self._start = time.time()
+        self._last = 0.0
+        self._flushed = 0.0
+        self.count = 0
+    
+    def record(self, owner_type, worker, type_, msg):
+        
+        # The wall clock may be stepped backwards; keep our times monotonic.
+        now = max(self._last, time.time() - self._start)
+        self._last = now
+        
+        marshal.dump((
+            now,
+            owner_type,
+            None if worker is None else worker.uuid,
+            type_,
+            _strip(msg),
+        ), self._fh)
+        self.count += 1
+        
+        # Don't lose much if the host dies.
+        if now - self._flushed > 1.0:
+            self._fh.flush()
+            self._flushed = now
+    
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def read(path):
+    """Iterate over the ``(time, owner_type, uuid, type, msg)`` records of a
+    trace."""
+    
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a uifutures trace: %r' % path)
+        while True:
+            try:
+                yield marshal.load(fh)
+            except EOFError:
+                return
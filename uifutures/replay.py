@@ -0,0 +1,180 @@
+"""Feeds a trace recorded by a host (see :mod:`uifutures.recorder`) back
+through the scheduler, and optionally the UI, as fast as it can::
+    
+    python -m uifutures.replay trace.bin --ui
+
+Nothing is actually run; workers are given a connection to nowhere, and the
+recorded messages from them are handled in the order they originally were,
+but not before the replayed scheduler has started them. Payloads are replaced
+by zeros of their original size.
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import time
+
+from .host import Host
+from .recorder import read
+from .states import BLOCKED, RETRYING
+
+
+class _NullConnection(object):
+    
+    def send(self, msg):
+        pass
+    
+    def close(self):
+        pass
+
+
+class ReplayHost(Host):
+    
+    """A :class:`.Host` which only schedules; it never starts processes or
+    touches anything outside of itself.
+    
+    It ignores the environment, so that replaying from a configured shell
+    doesn't write over that setup's metrics (or trace), and doesn't post
+    notifications.
+    
+    """
+    
+    def __init__(self, max_workers=None):
+        super(ReplayHost, self).__init__(None, environ={})
+        self.max_workers_override = max_workers
+        # Workers which were started since we last looked.
+        self.started = []
+    
+    def do_executor_config(self, trace_path=None, agent_address=None, agent_authkey=None,
+        profile_dir=None, metrics_path=None, **msg
+    ):
+        super(ReplayHost, self).do_executor_config(**msg)
+        if self.max_workers_override is not None:
+            self.max_workers = self.max_workers_override
+    
+    def start_worker(self, worker, slot):
+        worker.last_seen = None
+        self.check_watchdog(worker)
+        timer = self.affinity_waits.pop(worker.id, None)
+        if timer is not None:
+            self.cancel_timer(timer)
+        worker.conn = _NullConnection()
+        self.started.append(worker)
+    
+    def notify(self, **kwargs):
+        pass
+    
+    def release_process(self, worker):
+        worker.conn = None
+    
+    def call_later(self, delay, func, *args):
+        # Retries happen right away, as we are going faster than real time.
+        if func == self.retry:
+            delay = 0
+        return super(ReplayHost, self).call_later(delay, func, *args)
+
+
+def _waiting(worker):
+    return worker.state <= BLOCKED or worker.state == RETRYING
+
+
+def replay(path, max_workers=None, ui=False):
+    
+    host = ReplayHost(max_workers)
+    
+    if ui:
+        from uitools.qt import QtGui
+        from .host import Window
+        app = QtGui.QApplication.instance() or QtGui.QApplication([])
+        window = Window(host)
+        window.show()
+    
+    # Messages from jobs which we haven't started (or even been submitted)
+    # yet, by their uuid. Jobs are only known by uuid, as the order they are
+    # submitted in (and so their ids) may differ from the recording.
+    held = collections.defaultdict(list)
+    
+    results = dict(messages=0, dispatch_time=0, schedule_time=0, events_time=0)
+    
+    def deliver(owner_type, uuid, msg):
+        
+        queue = collections.deque([(owner_type, uuid, msg)])
+        while queue:
+            
+            owner_type, uuid, msg = queue.popleft()
+            worker = None
+            if owner_type == 'worker':
+                id_ = host.ids.get(uuid)
+                worker = None if id_ is None else host.workers[id_]
+                if worker is None or _waiting(worker):
+                    held[uuid].append(msg)
+                    continue
+            
+            if msg.get('type') == 'submit' and isinstance(msg.get('package'), int):
+                msg['package'] = '\0' * msg['package']
+            
+            t1 = time.time()
+            host.dispatch(owner_type, worker, msg)
+            t2 = time.time()
+            host.schedule()
+            t3 = time.time()
+            if ui:
+                app.processEvents()
+            results['dispatch_time'] += t2 - t1
+            results['schedule_time'] += t3 - t2
+            results['events_time'] += time.time() - t3
+            results['messages'] += 1
+            
+            # Anything we were holding for workers which just started.
+            while host.started:
+                started = host.started.pop(0)
+                queue.extend(('worker', started.uuid, x) for x in held.pop(started.uuid, ()))
+    
+    recorded = 0
+    start = time.time()
+    
+    for recorded, owner_type, uuid, type_, msg in read(path):
+        msg['type'] = type_
+        if uuid in held:
+            held[uuid].append(msg)
+        else:
+            deliver(owner_type, uuid, msg)
+    
+    # Let the scheduler get to everything it hasn't yet.
+    while held:
+        host.schedule()
+        if not host.started:
+            break
+        started = host.started.pop(0)
+        for msg in held.pop(started.uuid, ()):
+            deliver('worker', started.uuid, msg)
+    
+    results['elapsed'] = time.time() - start
+    results['messages_per_sec'] = results['messages'] / results['elapsed'] if results['elapsed'] else None
+    results['jobs'] = len(host.workers)
+    results['recorded_duration'] = recorded
+    results['undelivered'] = sum(len(x) for x in held.itervalues())
+    
+    host.store.close()
+    return results
+
+
+def main():
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace')
+    parser.add_argument('-w', '--max-workers', type=int, help='override the recorded max_workers')
+    parser.add_argument('--ui', action='store_true', help='drive the job queue window too')
+    opts = parser.parse_args()
+    
+    if opts.ui:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    
+    results = replay(opts.trace, opts.max_workers, opts.ui)
+    print json.dumps(results, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
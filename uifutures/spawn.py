@@ -0,0 +1,210 @@
+from multiprocessing import connection
+from multiprocessing import reduction
+import errno
+import os
+import signal
+import subprocess
+import time
+
+
+def preload(modules):
+    """Import the given modules (a list, or comma-separated string).
+    
+    Workers do this before their handshake so that a job's unpickling doesn't
+    pay for them. They are only imported into ``sys.modules``, so the
+    ``__main__`` of :mod:`uifutures.sandbox.the_corner` stays clean.
+    
+    """
+    if isinstance(modules, basestring):
+        modules = modules.split(',')
+    for name in modules:
+        name = name.strip()
+        if name:
+            __import__(name)
+
+
+class Process(object):
+    
+    """A worker process, and the host's end of its pipe."""
+    
+    __slots__ = ('proc', 'conn', 'pid', 'spawned_at', 'ready_at', 'affinity_key')
+    
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.pid = None
+        self.spawned_at = time.time()
+        # Set when the process has handshaken (and so finished preloading).
+        self.ready_at = None
+        # The affinity_key of the last job it ran, if it is being reused.
+        self.affinity_key = None
+
+
+class ForkedProc(object):
+    
+    """Stands in for a :class:`subprocess.Popen` for workers forked by the
+    fork server, which reaps them for us."""
+    
+    __slots__ = ('pid', )
+    
+    def __init__(self, pid):
+        self.pid = pid
+    
+    def poll(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return -1
+            raise
+    
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+    
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def _popen(cmd, env, fd):
+    
+    # Don't leak our end of other workers' pipes into this one, or they
+    # will never see EOF when we close them.
+    def close_fds():
+        os.closerange(3, fd)
+        os.closerange(fd + 1, subprocess.MAXFD)
+    
+    return subprocess.Popen(cmd, env=env, preexec_fn=close_fds)
+
+
+class Spawner(object):
+    
+    """Creates worker processes for the host, keeping up to ``prespawn`` of
+    them idle and waiting (having already imported ``preload``) so that jobs
+    don't wait on interpreter startup and imports."""
+    
+    def __init__(self, preload=None, prespawn=0, fork_server=False):
+        self.preload = preload or []
+        self.prespawn = prespawn
+        
+        # Use a uifutures.forkserver to create workers; it is started lazily,
+        # and we fall back to fresh interpreters if it ever dies.
+        self.fork_server = fork_server
+        self._server_proc = None
+        self._server_conn = None
+        
+        # Idle processes, by their connection.
+        self.idle = {}
+    
+    def _get_env(self):
+        if not self.preload:
+            return
+        env = dict(os.environ)
+        env['UIFUTURES_PRELOAD'] = ','.join(self.preload)
+        return env
+    
+    def spawn(self):
+        
+        conn, child_conn = connection.Pipe()
+        try:
+            proc = None
+            if self.fork_server:
+                proc = self._fork(child_conn.fileno())
+            if proc is None:
+                fd = child_conn.fileno()
+                cmd = ['python', '-m', 'uifutures.sandbox.the_corner', str(fd)]
+                proc = _popen(cmd, self._get_env(), fd)
+        finally:
+            child_conn.close()
+        
+        return Process(proc, conn)
+    
+    def _fork(self, fd):
+        
+        if self._server_conn is None:
+            self._server_conn, child_conn = connection.Pipe()
+            child_fd = child_conn.fileno()
+            cmd = ['python', '-m', 'uifutures.forkserver', str(child_fd)]
+            self._server_proc = _popen(cmd, self._get_env(), child_fd)
+            child_conn.close()
+        
+        try:
+            self._server_conn.send(dict(type='fork'))
+            reduction.send_handle(self._server_conn, fd, self._server_proc.pid)
+            msg = self._server_conn.recv()
+        except (EOFError, IOError, OSError):
+            self.fork_server = False
+            self._close_server()
+            return
+        
+        return ForkedProc(msg['pid'])
+    
+    def _close_server(self):
+        if self._server_conn is not None:
+            self._server_conn.close()
+            self._server_conn = None
+            self._server_proc = None
+    
+    def acquire(self, affinity_key=None):
+        """Get a process for a job, preferring idle ones which are ready, and
+        of those ones which last ran a job with the same ``affinity_key``."""
+        
+        if self.idle:
+            ready = [x for x in self.idle.itervalues() if x.ready_at is not None]
+            if affinity_key is not None:
+                ready = [x for x in ready if x.affinity_key == affinity_key] or ready
+            process = min(ready or self.idle.values(), key=lambda x: x.spawned_at)
+            del self.idle[process.conn]
+            return process
+        
+        return self.spawn()
+    
+    def has_affinity(self, affinity_key):
+        for process in self.idle.itervalues():
+            if process.affinity_key == affinity_key:
+                return True
+        return False
+    
+    def release(self, proc, conn, affinity_key=None):
+        """Take back a process which has finished a job, to run another."""
+        process = Process(proc, conn)
+        process.pid = proc.pid
+        process.ready_at = time.time()
+        process.affinity_key = affinity_key
+        self.idle[conn] = process
+    
+    def refill(self):
+        while len(self.idle) < self.prespawn:
+            process = self.spawn()
+            self.idle[process.conn] = process
+    
+    def handle_idle(self, conn):
+        """Read from an idle process's connection; returns the process if it
+        just became ready, or None."""
+        
+        process = self.idle[conn]
+        try:
+            msg = conn.recv()
+        except (EOFError, IOError):
+            # It died before we could use it.
+            del self.idle[conn]
+            return
+        
+        if msg.get('type') == 'handshake':
+            process.pid = msg['pid']
+            process.ready_at = time.time()
+            return process
+    
+    def close(self):
+        # Workers exit quietly when their pipe closes before they get a job.
+        for conn in self.idle:
+            conn.close()
+        self.idle.clear()
+        self._close_server()
+
@@ -0,0 +1,24 @@
+# States are small ints, ordered so that the scheduler can classify them
+# with a single comparison: waiting states are <= BLOCKED, finished ones are
+# >= COMPLETE, and failed ones are >= FAILED. A job which failed but will be
+# retried is neither waiting nor finished, so its dependents stay BLOCKED.
+INITED = 0
+QUEUED = 1
+BLOCKED = 2
+ACTIVE = 3
+RETRYING = 4
+COMPLETE = 5
+FAILED = 6
+DEPENDENCY_FAILED = 7
+
+# For messages to the UI.
+state_names = (
+    'INITED',
+    'QUEUED',
+    'BLOCKED',
+    'ACTIVE',
+    'RETRYING',
+    'COMPLETE',
+    'FAILED',
+    'DEPENDENCY_FAILED',
+)
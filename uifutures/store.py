@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+
+class Spilled(object):
+    
+    """Describes a package which has been written to disk."""
+    
+    __slots__ = ('path', 'size')
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+
+class PackageStore(object):
+    
+    """Keeps pickled job packages out of the host's memory until needed.
+    
+    Packages at least ``threshold`` bytes long are written to a temporary
+    directory, and :meth:`put` returns a :class:`Spilled` descriptor in their
+    place; smaller ones are returned as-is since a file would cost more than
+    it saves. Either may be given to :meth:`get` and :meth:`discard`.
+    
+    """
+    
+    def __init__(self, threshold=64 * 1024, dir_path=None):
+        self.threshold = threshold
+        self.dir_path = dir_path
+        self._own_dir = False
+        self.spilled_count = 0
+        self.spilled_bytes = 0
+    
+    def put(self, uuid, package):
+        
+        if self.threshold is None or len(package) < self.threshold:
+            return package
+        
+        if self.dir_path is None:
+            self.dir_path = tempfile.mkdtemp(prefix='uifutures.')
+            self._own_dir = True
+        elif not os.path.exists(self.dir_path):
+            os.makedirs(self.dir_path)
+        
+        path = os.path.join(self.dir_path, '%s.pkl' % uuid)
+        with open(path, 'wb') as fh:
+            fh.write(package)
+        
+        self.spilled_count += 1
+        self.spilled_bytes += len(package)
+        return Spilled(path, len(package))
+    
+    def get(self, ref):
+        if not isinstance(ref, Spilled):
+            return ref
+        with open(ref.path, 'rb') as fh:
+            return fh.read()
+    
+    def discard(self, ref):
+        if not isinstance(ref, Spilled):
+            return
+        self.spilled_count -= 1
+        self.spilled_bytes -= ref.size
+        try:
+            os.unlink(ref.path)
+        except OSError:
+            pass
+    
+    def close(self):
+        if self._own_dir and self.dir_path and os.path.exists(self.dir_path):
+            shutil.rmtree(self.dir_path)
+
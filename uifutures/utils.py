@@ -1,23 +1,16 @@
 from subprocess import call
 import os
 import re
-import sys
-import thread
 import time
+import zlib
 
-
-_debug_start = time.time()
-_debug_last = _debug_start
-_debug_thread_ids = {}
-def debug(msg, *args):
-    global _debug_last
-    if args:
-        msg = msg % args
-    ident = _debug_thread_ids.setdefault(thread.get_ident(), len(_debug_thread_ids))
-    current_time = time.time()
-    sys.stdout.write('# %8.3f (%8.3f) %3d %s\n' % ((current_time - _debug_start) * 1000, (current_time - _debug_last) * 1000, ident, msg))
-    sys.stdout.flush()
-    _debug_last = current_time
+try:
+    import lz4.block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
 
 
 def get_func(spec):
@@ -38,6 +31,93 @@ def get_func_name(spec):
     return '%s:%s' % (getattr(spec, '__module__', '__module__'), getattr(spec, '__name__', str(spec)))
 
 
+# (name, start stamp, end stamp) for each phase of a job's life.
+_stats_phases = [
+    ('submit', 'submitted', 'received'),
+    ('spawn', 'started', 'spawned'),
+    ('unpickle', 'job_received', 'run_started'),
+    ('run', 'run_started', 'run_finished'),
+    ('pickle', 'run_finished', 'result_pickled'),
+    ('relay', 'result_pickled', 'relayed'),
+]
+
+def get_durations(stats):
+    """Turn the timestamps collected for a job into a list of ``(phase,
+    seconds)`` pairs, skipping any phases we don't have both ends of."""
+    
+    durations = []
+    
+    # Time spent waiting to start which wasn't spent waiting on dependencies.
+    if 'received' in stats and 'started' in stats:
+        durations.append(('queue', stats['started'] - stats['received'] - stats.get('blocked', 0)))
+    if 'blocked' in stats:
+        durations.append(('blocked', stats['blocked']))
+    
+    for name, start, end in _stats_phases:
+        if start in stats and end in stats:
+            durations.append((name, stats[end] - stats[start]))
+    
+    return durations
+
+
+# Compression codecs for pickled packages, by name; (compress, decompress).
+codecs = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if lz4 is not None:
+    codecs['lz4'] = (lz4.compress, lz4.decompress)
+
+# In order of preference.
+available_codecs = [x for x in ('lz4', 'zlib') if x in codecs]
+
+
+def pack(data, codec, threshold=0, stats=None, prefix='package'):
+    """Compress a pickled payload with the given codec if it is at least
+    ``threshold`` bytes long and compression actually helps.
+    
+    Returns ``(data, codec)``, where codec is None if the data was left alone.
+    Sizes, ratio and time are recorded into ``stats`` under the given prefix.
+    
+    """
+    
+    if codec not in codecs or len(data) < (threshold or 0):
+        return data, None
+    
+    start_time = time.time()
+    compressed = codecs[codec][0](data)
+    if stats is not None:
+        stats[prefix + '_size'] = len(data)
+        stats[prefix + '_compressed_size'] = len(compressed)
+        stats[prefix + '_ratio'] = float(len(data)) / max(1, len(compressed))
+        stats[prefix + '_compress_time'] = time.time() - start_time
+    
+    if len(compressed) >= len(data):
+        return data, None
+    return compressed, codec
+
+
+def unpack(data, codec, stats=None, prefix='package'):
+    """Undo :func:`pack`."""
+    if not codec:
+        return data
+    start_time = time.time()
+    data = codecs[codec][1](data)
+    if stats is not None:
+        stats[prefix + '_decompress_time'] = time.time() - start_time
+    return data
+
+
+def save_profile(dir_path, uuid, profile):
+    """Save a job's marshalled cProfile stats so that they may be loaded by
+    :mod:`pstats`; returns the path."""
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    path = os.path.join(dir_path, '%s.prof' % uuid)
+    with open(path, 'wb') as fh:
+        fh.write(profile)
+    return path
+
+
 def icon(name):
     base, ext = os.path.splitext(name)
     return os.path.abspath(os.path.join(
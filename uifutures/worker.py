@@ -3,23 +3,52 @@ import _multiprocessing
 import sys
 import os
 import cPickle as pickle
+import cProfile
+import errno
+import inspect
+import marshal
+import resource
+import threading
+import time
 import traceback
 
+from uifutures import log
+from uifutures import utils
+from uifutures.future import Future
+
 
 _conn = None
 _job = {}
 
+# Set once the job submits a subjob; see submit_ext.
+_subjobs = None
+
+# Jobs running inside an in-process backend (see Executor's "thread" and
+# "process_pool" backends) get their connection and job via this instead of
+# the module globals.
+_local = threading.local()
+
+
+def _get_conn():
+    return getattr(_local, 'conn', None) or _conn
+
+
+def _get_job():
+    return getattr(_local, 'job', None) or _job
+
 
 def notify(message, **kwargs):
-    if _conn:
+    conn = _get_conn()
+    if conn is not None:
         kwargs['type'] = 'notify'
         kwargs['message'] = message
-        _conn.send(kwargs)
+        conn.send(kwargs)
 
 
 def set_progress(value=None, maximum=None, status=None):
-    if _conn is not None:
-        _conn.send(dict(
+    conn = _get_conn()
+    if conn is not None:
+        conn.send(dict(
             type='progress',
             value=value,
             maximum=maximum,
@@ -27,28 +56,329 @@ def set_progress(value=None, maximum=None, status=None):
         ))
 
 def set_thumbnail(path):
-    if _conn is not None:
-        _conn.send(dict(
+    conn = _get_conn()
+    if conn is not None:
+        conn.send(dict(
             type='thumbnail',
             path=path,
         ))
 
+class _LockedConnection(object):
+    
+    """Lets other threads (i.e. heartbeats and subjobs) share the job's pipe."""
+    
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+    
+    def send(self, msg):
+        with self._lock:
+            self._conn.send(msg)
+    
+    def recv(self):
+        return self._conn.recv()
+
+
+def _heartbeat(conn, interval, done):
+    while not done.wait(interval):
+        try:
+            conn.send(dict(type='heartbeat'))
+        except IOError:
+            return
+
+
+class _Subjobs(object):
+    
+    """Reads the host's messages about our subjobs into their futures.
+    
+    Once this is running it also owns the acknowledgements of streamed items,
+    as nothing else may read from the pipe.
+    
+    """
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.futures = {}
+        self.acked = 0
+        self.ack_cond = threading.Condition()
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+    
+    def _read(self):
+        
+        while True:
+            
+            try:
+                msg = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            
+            type_ = msg.pop('type', None)
+            uuid = msg.pop('subjob', None)
+            
+            if type_ == 'ack' and uuid is None:
+                with self.ack_cond:
+                    self.acked += msg['count']
+                    self.ack_cond.notify_all()
+                continue
+            
+            future = self.futures.get(uuid)
+            if future is None:
+                continue
+            
+            if type_ == 'yield':
+                future._stream_put(pickle.loads(utils.unpack(msg['package'], msg.get('package_codec')))['item'])
+            elif type_ == 'retry':
+                future.retries = msg['attempt']
+            elif type_ == 'result':
+                del self.futures[uuid]
+                future.stats.update(msg.get('stats') or {})
+                package = utils.unpack(msg['package'], msg.get('package_codec'), future.stats, 'result')
+                future.set_result(pickle.loads(package)['result'])
+            elif type_ == 'exception':
+                del self.futures[uuid]
+                future.stats.update(msg.get('stats') or {})
+                future.set_exception((pickle.loads(msg['package']) if 'package' in msg else msg)['exception'])
+        
+        from uifutures.executor import HostShutdown
+        for future in self.futures.values():
+            future.set_exception(HostShutdown('host shutdown'))
+    
+    def wait_for_acks(self):
+        with self.ack_cond:
+            while not self.acked:
+                self.ack_cond.wait()
+            count, self.acked = self.acked, 0
+        return count
+
+
+def submit(func, *args, **kwargs):
+    """Submit a subjob; see :func:`submit_ext`."""
+    return submit_ext(func, args, kwargs)
+
+
+def submit_ext(func, args=None, kwargs=None, name=None, icon=None, depends_on=None,
+    retries=0, retry_backoff=1.0, job_timeout=None
+):
+    """Submit a subjob to the host running the current job.
+    
+    The host schedules subjobs like any other, and shows them under this job.
+    Returns a :class:`.Future`, which may be waited on, or passed as another
+    subjob's ``depends_on``. While it has unfinished subjobs, the current job
+    does not count against ``max_workers``.
+    
+    """
+    
+    global _subjobs
+    
+    if getattr(_local, 'conn', None) is not None or _conn is None:
+        raise RuntimeError('subjobs can only be submitted from jobs run by the host')
+    if _subjobs is None:
+        _subjobs = _Subjobs(_conn)
+    
+    uuid = os.urandom(16).encode('hex')
+    func_name = utils.get_func_name(func)
+    
+    depends_on = depends_on or []
+    if not isinstance(depends_on, (list, tuple)):
+        depends_on = [depends_on]
+    
+    package, codec = _pack(dict(
+        func=func,
+        args=tuple(args or ()),
+        kwargs=dict(kwargs or {}),
+    ), prefix='package')
+    
+    future = Future(uuid, func_name)
+    future.stats['submitted'] = submitted = time.time()
+    _subjobs.futures[uuid] = future
+    
+    msg = dict(
+        type='submit',
+        subjob=uuid,
+        name=name or func_name,
+        icon=icon,
+        func_name=func_name,
+        depends_on=[x.uuid for x in depends_on],
+        package=package,
+        package_codec=codec,
+        submitted=submitted,
+    )
+    if retries:
+        msg['retries'] = retries
+        msg['retry_backoff'] = retry_backoff
+    if job_timeout:
+        msg['job_timeout'] = job_timeout
+    
+    # Subjobs run the same way we do.
+    job = _get_job()
+    for key in ('stream_window', 'heartbeat_interval', 'result_codec', 'compression_threshold'):
+        if key in job:
+            msg[key] = job[key]
+    
+    _conn.send(msg)
+    return future
+
+
 def main():
     
     global _conn
     
+    # Import everything the host asked us to before we announce ourselves,
+    # as we may be pre-spawned and waiting for a job.
+    preload = os.environ.get('UIFUTURES_PRELOAD')
+    if preload:
+        from uifutures.spawn import preload as do_preload
+        do_preload(preload)
+    
+    log.install_signal_handler()
+    
     # Connect to the executor, and start the listener.
     fd = int(sys.argv[1])
     _conn = conn = _multiprocessing.Connection(fd)
-    conn.send(dict(
-        type='handshake',
-        pid=os.getpid(),
-    ))
     
+    # The host may close our pipe if it doesn't need us after all.
     try:
-        process(conn)
-    except Exception as e:
         conn.send(dict(
+            type='handshake',
+            pid=os.getpid(),
+        ))
+    except IOError as e:
+        if e.errno == errno.EPIPE:
+            return
+        raise
+    try:
+        while process(conn):
+            pass
+    except EOFError:
+        pass
+    except:
+        log.dump()
+        raise
+
+def process(conn):
+    """Run one job from the host; returns True if we should wait for another."""
+    
+    # Get the message, skipping anything left over from our last job (i.e.
+    # acknowledgements of items it streamed).
+    rlist, _, _ = select.select([conn], [], [])
+    msg = conn.recv()
+    while msg.get('type') != 'submit':
+        msg = conn.recv()
+    log.debug('Worker: received %s', msg.get('uuid'))
+    
+    return execute(conn, msg)
+
+
+def _stream(conn, gen, window):
+    """Send each item of a generator back as a "yield" message.
+    
+    If there is a ``window``, we stop once that many items have not been
+    acknowledged, so that a fast job can't flood the host.
+    
+    """
+    unacked = 0
+    for item in gen:
+        package, codec = _pack(dict(item=item))
+        conn.send(dict(
+            type='yield',
+            package=package,
+            package_codec=codec,
+        ))
+        unacked += 1
+        while window and unacked >= window:
+            if _subjobs is not None:
+                unacked -= _subjobs.wait_for_acks()
+                continue
+            msg = conn.recv()
+            if msg.get('type') == 'ack':
+                unacked -= msg['count']
+
+
+def _pack(obj, stats=None, prefix='result'):
+    job = _get_job()
+    return utils.pack(
+        pickle.dumps(obj, protocol=-1),
+        job.get('result_codec'),
+        job.get('compression_threshold'),
+        stats,
+        prefix,
+    )
+
+
+def _get_rusage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+
+def execute(conn, msg, local=False, rusage=True):
+    """Run the job described by the given submit message, sending the result
+    or exception back over the given connection.
+    
+    If ``local``, the job's connection is only visible to the current thread.
+    Resource usage is only reported if ``rusage``, as it is meaningless when
+    other jobs share the process.
+    
+    If the job was submitted with ``profile``, or ``$UIFUTURES_PROFILE`` is set,
+    the function is run under cProfile and the marshalled stats are sent back
+    with the result.
+    
+    If the function returns a generator, its items are streamed back as they
+    are produced (see :meth:`.Future.stream`), and the result is None.
+    
+    Returns True if the host may reuse this process for another job, which
+    it asks for with ``reuse``; we can't once the pipe is owned by subjobs.
+    
+    """
+    
+    global _conn, _job
+    
+    stats = {'job_received': time.time()}
+    profiler = cProfile.Profile() if (msg.get('profile') or os.environ.get('UIFUTURES_PROFILE')) else None
+    if rusage:
+        start_usage = _get_rusage()
+    
+    if local:
+        _local.conn = conn
+        _local.job = msg
+    else:
+        _job = msg
+    
+    # The heartbeat and subjobs may send from other threads.
+    if not local:
+        _conn = conn = _LockedConnection(conn)
+    
+    # Let the host know we are still alive while the job runs.
+    heartbeat_done = None
+    if msg.get('heartbeat_interval') and not local:
+        heartbeat_done = threading.Event()
+        heartbeat_thread = threading.Thread(target=_heartbeat, args=(conn, msg['heartbeat_interval'], heartbeat_done))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+    
+    try:
+        package = pickle.loads(utils.unpack(msg['package'], msg.get('package_codec'), stats))
+        stats['run_started'] = time.time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            res = package['func'](*package['args'], **package['kwargs'])
+            if inspect.isgenerator(res):
+                _stream(conn, res, msg.get('stream_window'))
+                res = None
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        stats['run_finished'] = time.time()
+        package, codec = _pack(dict(result=res), stats)
+        out = dict(
+            type='result',
+            package=package,
+            package_codec=codec,
+        )
+    except Exception as e:
+        out = dict(
             type='exception',
             exception_name=type(e).__name__,
             exception_message=str(e),
@@ -56,25 +386,34 @@ def main():
             package=pickle.dumps(dict(
                 exception=e,
             ), protocol=-1),
-        ))
-
-def process(conn):
+        )
+    finally:
+        if local:
+            _local.conn = None
+            _local.job = None
+        if heartbeat_done is not None:
+            # Wait for it, so that it isn't torn down mid-wait if we exit.
+            heartbeat_done.set()
+            heartbeat_thread.join()
     
-    global _job
+    stats['result_pickled'] = time.time()
+    if rusage:
+        end_usage = _get_rusage()
+        stats['user_time'] = end_usage[0] - start_usage[0]
+        stats['system_time'] = end_usage[1] - start_usage[1]
+        # Linux reports this in KB, but OS X in bytes.
+        stats['max_rss'] = end_usage[2] * (1 if sys.platform == 'darwin' else 1024)
     
-    # Get the message.
-    rlist, _, _ = select.select([conn], [], [])
-    _job = msg = conn.recv()
-    # debug('Worker: recieved message\n%s', pprint.pformat(msg))
-    
-    package = pickle.loads(msg['package'])
-    res = package['func'](*package['args'], **package['kwargs'])
-    conn.send(dict(
-        type='result',
-        package=pickle.dumps(dict(
-            result=res
-        ), protocol=-1),
-    ))
+    out['stats'] = stats
+    if profiler is not None:
+        profiler.create_stats()
+        out['profile'] = marshal.dumps(profiler.stats)
+    if msg.get('reuse') and not local and _subjobs is None:
+        out['reusable'] = True
+    log.debug('Worker: %s sending %s', msg.get('uuid'), out['type'])
+    conn.send(out)
+    
+    return out.get('reusable', False)
     
 
 if __name__ == '__main__':